@@ -0,0 +1,75 @@
+# FASTQ -> renamed FASTA.gz throughput: the per-record text loop the pipeline
+# used to run against the chunked migseq2.fastx converter with 1..N BGZF threads.
+#
+#   python bench/bench_fastx.py --reads 200000 -t 4
+#   python bench/bench_fastx.py --fastq sample_R1.fastq.gz
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from migseq2 import fastx  # noqa: E402
+
+
+def make_fastq(path, n_reads, read_len, seed):
+    rng = random.Random(seed)
+    qual = 'I' * read_len
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        for i in range(n_reads):
+            seq = ''.join(rng.choice('ACGT') for _ in range(read_len))
+            f.write(f'@read{i} 1:N:0:1\n{seq}\n+\n{qual}\n')
+
+
+def per_record(fastq_file, out_file):
+    # one parsed record and one write call per read, as before the chunked reader
+    n = 0
+    with gzip.open(fastq_file, 'rt') as fq, gzip.open(out_file, 'wt') as out:
+        for header in fq:
+            seq = next(fq)
+            next(fq)
+            next(fq)
+            print(f'>S:{header[1:].split()[0]}/1', file=out)
+            print(seq.rstrip(), file=out)
+            n += 1
+    return n
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    n = func(*args)
+    return n, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fastq', default=None, help='FASTQ(.gz) to convert (default: a synthetic file)')
+    parser.add_argument('--reads', type=int, default=200000, help='Reads in the synthetic file')
+    parser.add_argument('--read_len', type=int, default=100, help='Read length of the synthetic file')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Largest BGZF thread count to try')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='migseq_fastx_') as tmp:
+        fastq = args.fastq
+        if fastq is None:
+            fastq = os.path.join(tmp, 'in.fastq.gz')
+            make_fastq(fastq, args.reads, args.read_len, 1)
+        out = os.path.join(tmp, 'out.fasta.gz')
+        rows = [('per-record gzip text',) + timed(per_record, fastq, out)]
+        threads = 1
+        while threads <= args.threads:
+            rows.append((f'chunked BGZF, {threads} thread(s)',) + timed(
+                fastx.fastq_to_fasta, 'S', 1, fastq, out, None, threads))
+            threads *= 2
+    base = rows[0][1] / rows[0][2]
+    print(f'{"method":<28}{"reads":>12}{"seconds":>10}{"reads/s":>12}{"speedup":>9}')
+    for name, n, wall in rows:
+        print(f'{name:<28}{n:>12}{wall:>10.2f}{n / wall:>12.0f}{n / wall / base:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
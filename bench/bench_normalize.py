@@ -0,0 +1,94 @@
+# Digital normalization (--normalize) throughput: the per-k-mer Python count-min
+# sketch the pipeline used to run against the NumPy one in migseq2.denovo, on a
+# deep synthetic sample (few loci, many reads per locus, sequencing errors).
+#
+#   python bench/bench_normalize.py --pairs 200000 --target 20
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from migseq2.denovo import NORM_K, normalize_pairs  # noqa: E402
+
+REVCOMP = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+
+
+def make_pairs(n_pairs, n_loci, read_len, error_rate, seed):
+    rng = random.Random(seed)
+    loci = [bytes(rng.choice(b'ACGT') for _ in range(2 * read_len)) for _ in range(n_loci)]
+    qual = b'I' * read_len
+    pairs = []
+    for i in range(n_pairs):
+        locus = bytearray(rng.choice(loci))
+        for _ in range(int(len(locus) * error_rate)):
+            locus[rng.randrange(len(locus))] = rng.choice(b'ACGT')
+        r1 = bytes(locus[:read_len])
+        r2 = bytes(locus[::-1][:read_len]).translate(REVCOMP)
+        pairs.append((b'@r%d 1\n%s\n+\n%s\n' % (i, r1, qual), b'@r%d 2\n%s\n+\n%s\n' % (i, r2, qual)))
+    return pairs
+
+
+def python_sketch(pairs, target, k=NORM_K, width=1 << 22, depth=4):
+    # one crc32/adler32 double hash and one list of slots per k-mer, as before NumPy
+    tables = [bytearray(width) for _ in range(depth)]
+
+    def slots(kmer):
+        h1 = zlib.crc32(kmer)
+        h2 = zlib.adler32(kmer) | 1
+        return [(h1 + i * h2) % width for i in range(depth)]
+
+    for rec1, rec2 in pairs:
+        read_slots = []
+        keep = False
+        for rec in (rec1, rec2):
+            seq = rec.split(b'\n', 2)[1].upper()
+            rc = seq.translate(REVCOMP)[::-1]
+            n = len(seq) - k + 1
+            kmers = [slots(min(seq[i:i + k], rc[n - 1 - i:n - 1 - i + k])) for i in range(n)]
+            if not kmers:
+                continue
+            counts = sorted(min(t[s] for t, s in zip(tables, slot)) for slot in kmers)
+            if counts[len(counts) // 2] < target:
+                keep = True
+            read_slots += kmers
+        if keep or not read_slots:
+            for slot in read_slots:
+                for t, s in zip(tables, slot):
+                    if t[s] < 255:
+                        t[s] += 1
+            yield rec1, rec2
+
+
+def timed(func, pairs, target):
+    start = time.perf_counter()
+    kept = sum(1 for _ in func(pairs, target))
+    return len(pairs), kept, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=200000, help='Read pairs in the synthetic sample')
+    parser.add_argument('--baseline_pairs', type=int, default=20000, help='Read pairs given to the slow Python sketch')
+    parser.add_argument('--loci', type=int, default=500, help='Loci the reads are drawn from')
+    parser.add_argument('--read_len', type=int, default=150, help='Read length')
+    parser.add_argument('--error_rate', type=float, default=0.005, help='Per-base error rate')
+    parser.add_argument('--target', type=int, default=20, help='Normalization target coverage')
+    args = parser.parse_args()
+    pairs = make_pairs(args.pairs, args.loci, args.read_len, args.error_rate, 1)
+    rows = [
+        ('python count-min sketch',) + timed(python_sketch, pairs[:args.baseline_pairs], args.target),
+        ('numpy count-min sketch',) + timed(normalize_pairs, pairs, args.target),
+    ]
+    base = rows[0][1] / rows[0][3]
+    print(f'{"method":<26}{"pairs":>10}{"kept":>10}{"seconds":>10}{"pairs/s":>12}{"speedup":>9}')
+    for name, n, kept, wall in rows:
+        print(f'{name:<26}{n:>10}{kept:>10}{wall:>10.2f}{n / wall:>12.0f}{n / wall / base:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
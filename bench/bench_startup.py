@@ -0,0 +1,84 @@
+# Interpreter startup cost of the command line entry points: wall time of a
+# fresh `python -m migseq2 <args>` process and the heavy modules it imported.
+# Short --from_fa/--from_bam re-analysis jobs pay this once per job.
+#
+#   python bench/bench_startup.py --repeat 20
+#   python bench/bench_startup.py --args="mapping --help" --importtime
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# modules that should only be loaded by the stages that need them
+HEAVY = ('numpy', 'pysam', 'pandas', 'Bio', 'cProfile', 'pstats', 'configparser', 'sqlite3')
+DEFAULT_ARGS = ['--help', 'denovo --help', 'mapping --help']
+
+
+def run_once(args):
+    # wall time of one process, plus the top-level modules it imported
+    code = (
+        'import sys, runpy; sys.argv = ["migseq2"] + sys.argv[1:]\n'
+        'try:\n'
+        '    runpy.run_module("migseq2", run_name="__main__")\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'sys.stderr.write("\\n#modules " + " ".join(sorted({m.split(".")[0] for m in sys.modules})) + "\\n")\n')
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-c', code] + args.split(), cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    modules = proc.stderr.rsplit('#modules ', 1)[-1].split()
+    return wall, modules
+
+
+def baseline(repeat):
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        walls.append(time.perf_counter() - start)
+    return statistics.median(walls)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--args', action='append', default=[], help='Arguments after `migseq2` to time (repeatable, default: --help and both pipelines\' --help)')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per command; the median is reported')
+    parser.add_argument('--importtime', action='store_true', help='Also print the 15 slowest imports of each command (python -X importtime)')
+    args = parser.parse_args()
+    commands = args.args or DEFAULT_ARGS
+    base = baseline(args.repeat)
+    print(f'{"command":<28}{"median s":>10}{"over python":>13}  heavy modules imported')
+    print(f'{"python -c pass":<28}{base:>10.3f}{0:>13.3f}')
+    for command in commands:
+        walls = []
+        for _ in range(args.repeat):
+            wall, modules = run_once(command)
+            walls.append(wall)
+        heavy = [name for name in HEAVY if name in modules]
+        median = statistics.median(walls)
+        print(f'{"migseq2 " + command:<28}{median:>10.3f}{median - base:>13.3f}  {", ".join(heavy) or "-"}')
+    if args.importtime:
+        for command in commands:
+            proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-m', 'migseq2'] + command.split(),
+                cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            rows = []
+            for line in proc.stderr.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                _, cumulative, name = (field.strip() for field in line[len('import time:'):].split('|'))
+                rows.append((int(cumulative), name))
+            print(f'\nslowest imports: migseq2 {command} (cumulative microseconds)')
+            for cumulative, name in sorted(rows, reverse=True)[:15]:
+                print(f'{cumulative:>10}  {name}')
+
+
+if __name__ == '__main__':
+    main()
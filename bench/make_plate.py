@@ -0,0 +1,94 @@
+# Generate a synthetic MIG-seq plate: paired {sample}_L00N_R{1,2}_001.fastq.gz files
+# drawn from a shared set of random loci, plus the loci as a reference FASTA.
+#
+#   python bench/make_plate.py -o plate -n 96 --reads 20000 --loci 2000
+import argparse
+import contextlib
+import gzip
+import os
+import random
+
+
+BASES = 'ACGT'
+
+
+def mutate(seq, rate, rng):
+    # point mutations at the given per-base rate
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < rate:
+            seq[i] = rng.choice(BASES)
+    return ''.join(seq)
+
+
+def revcomp(seq):
+    return seq[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+def make_loci(n_loci, locus_len, rng):
+    return [''.join(rng.choice(BASES) for _ in range(locus_len)) for _ in range(n_loci)]
+
+
+def sample_read_counts(n_samples, reads, skew, rng):
+    # log-uniform read counts between reads/sqrt(skew) and reads*sqrt(skew),
+    # so the deepest sample has about skew times the reads of the shallowest
+    if skew <= 1:
+        return [reads] * n_samples
+    low = reads / skew ** 0.5
+    return [int(low * skew ** rng.random()) for _ in range(n_samples)]
+
+
+def write_sample(outdir, sample, loci, n_reads, read_len, mutation_rate, rng, lanes=1):
+    # each sample carries its own alleles of every locus; reads are dealt
+    # round-robin over the lanes like a NovaSeq run split across L001-L00N
+    alleles = [mutate(locus, mutation_rate, rng) for locus in loci]
+    qual = 'I' * read_len
+    paths = [
+        tuple(os.path.join(outdir, f'{sample}_L{lane:03d}_R{read}_001.fastq.gz') for read in (1, 2))
+        for lane in range(1, lanes + 1)]
+    with contextlib.ExitStack() as stack:
+        handles = [
+            tuple(stack.enter_context(gzip.open(path, 'wt', compresslevel=1)) for path in pair)
+            for pair in paths]
+        for i in range(n_reads):
+            allele = rng.choice(alleles)
+            name = f'@{sample}.{i} '
+            r1, r2 = handles[i % lanes]
+            r1.write(f'{name}1:N:0\n{allele[:read_len]}\n+\n{qual}\n')
+            r2.write(f'{name}2:N:0\n{revcomp(allele)[:read_len]}\n+\n{qual}\n')
+    return paths
+
+
+def make_plate(outdir, n_samples, reads, n_loci, read_len=100, skew=1.0,
+               mutation_rate=0.01, seed=1, lanes=1):
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    loci = make_loci(n_loci, 2 * read_len, rng)
+    with open(os.path.join(outdir, 'loci.fasta'), 'w') as f:
+        for i, locus in enumerate(loci):
+            f.write(f'>locus{i}\n{locus}\n')
+    counts = sample_read_counts(n_samples, reads, skew, rng)
+    for i, n_reads in enumerate(counts):
+        write_sample(outdir, f'S{i + 1:04d}', loci, n_reads, read_len, mutation_rate, rng, lanes)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--outdir', required=True, help='Output directory for the plate')
+    parser.add_argument('-n', '--samples', type=int, default=96, help='Number of samples')
+    parser.add_argument('--reads', type=int, default=20000, help='Read pairs per sample (geometric mean)')
+    parser.add_argument('--loci', type=int, default=2000, help='Number of loci')
+    parser.add_argument('--read_len', type=int, default=100, help='Read length')
+    parser.add_argument('--skew', type=float, default=1.0, help='Ratio between the deepest and shallowest sample')
+    parser.add_argument('--lanes', type=int, default=1, help='Lanes each sample is split across')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+    counts = make_plate(
+        args.outdir, args.samples, args.reads, args.loci,
+        read_len=args.read_len, skew=args.skew, seed=args.seed, lanes=args.lanes)
+    print(f'{len(counts)} samples, {sum(counts)} read pairs written to {args.outdir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Orchestration benchmark: runs the pipelines on synthetic plates with the stub
+# tools from stubs.py and reports per-stage wall time and throughput from each
+# run's run_metrics.json, for a series of plate sizes.
+#
+#   python bench/run_bench.py --pipeline denovo --sizes 8,32,128 -t 8
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import make_plate  # noqa: E402
+import stubs  # noqa: E402
+
+
+def run_pipeline(pipeline, plate, outdir, threads, bindir, scratch=None):
+    # runs inside a fresh interpreter (see main) so loggers and pools start clean
+    os.makedirs(outdir, exist_ok=True)
+    os.chdir(outdir)
+    if pipeline == 'denovo':
+        from migseq2 import denovo
+        scc = denovo.SampleCodeClass(
+            plate, 20, 0, 0, threads, 30, outdir, 3, 2, 4, 0.8, '', scratch=scratch)
+        scc.run()
+        return
+    from migseq2 import mapping
+    scc = mapping.SampleCodeClass(
+        indir=plate, q=20, fada='A', rada='A', F_remove=0, R_remove=0,
+        t=threads, min_len=30, ref_genome=os.path.join(plate, 'loci.fasta'),
+        outdir=outdir, r=0.8, pop_opts='', scratch=scratch,
+        ref_cache=os.path.join(os.path.dirname(bindir), 'ref_cache'))
+    scc.path_to_stacks = bindir
+    scc.run()
+
+
+def bench_size(args, n_samples, bindir):
+    plate = os.path.join(args.workdir, f'plate_{n_samples}x{args.lanes}')
+    counts_file = os.path.join(plate, 'read_counts.json')
+    if not os.path.exists(counts_file):
+        counts = make_plate.make_plate(
+            plate, n_samples, args.reads, args.loci, skew=args.skew, seed=args.seed,
+            lanes=args.lanes)
+        with open(counts_file, 'w') as f:
+            json.dump(counts, f)
+    with open(counts_file) as f:
+        reads = sum(json.load(f))
+    outdir = os.path.join(args.workdir, f'{args.pipeline}_{n_samples}')
+    shutil.rmtree(outdir, ignore_errors=True)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get('PATH', ''))
+    cmd = [sys.executable, os.path.abspath(__file__), '_worker', args.pipeline,
+           plate, outdir, str(args.threads), bindir, args.scratch or '']
+    log = None if args.verbose else subprocess.DEVNULL
+    subprocess.run(cmd, env=env, check=True, stdout=log, stderr=log)
+    with open(os.path.join(outdir, 'run_metrics.json')) as f:
+        metrics = json.load(f)
+    stages = {}
+    for stage in metrics['stages']:
+        stages[stage['stage']] = {
+            'wall': stage['wall'],
+            'cpu': stage['cpu_self'] + stage['cpu_children'],
+            'samples_per_s': n_samples / stage['wall'] if stage['wall'] else None,
+            'reads_per_s': 2 * reads / stage['wall'] if stage['wall'] else None,
+        }
+    return {'samples': n_samples, 'read_pairs': reads, 'wall': metrics['wall'], 'stages': stages}
+
+
+def print_table(results):
+    sizes = [r['samples'] for r in results]
+    stage_names = []
+    for r in results:
+        stage_names += [s for s in r['stages'] if s not in stage_names]
+    print('wall seconds (samples/s) by plate size')
+    print(f'{"stage":<32}' + ''.join(f'{n:>22}' for n in sizes))
+    for name in stage_names:
+        row = f'{name:<32}'
+        for r in results:
+            stage = r['stages'].get(name)
+            if stage is None:
+                row += f'{"-":>22}'
+            else:
+                rate = stage['samples_per_s'] or 0
+                row += f'{stage["wall"]:>11.2f} ({rate:>8.1f})'
+        print(row)
+    print(f'{"total":<32}' + ''.join(f'{r["wall"]:>22.2f}' for r in results))
+
+
+def main():
+    if sys.argv[1:2] == ['_worker']:
+        pipeline, plate, outdir, threads, bindir, scratch = sys.argv[2:8]
+        run_pipeline(pipeline, plate, outdir, int(threads), bindir, scratch or None)
+        return
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pipeline', choices=['denovo', 'mapping'], default='denovo', help='Pipeline to benchmark')
+    parser.add_argument('--sizes', default='8,32,128', help='Comma-separated plate sizes (samples)')
+    parser.add_argument('--reads', type=int, default=5000, help='Read pairs per sample')
+    parser.add_argument('--loci', type=int, default=500, help='Number of loci')
+    parser.add_argument('--skew', type=float, default=1.0, help='Ratio between the deepest and shallowest sample')
+    parser.add_argument('--lanes', type=int, default=1, help='Lanes each sample is split across')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Threads passed to the pipeline')
+    parser.add_argument('--workdir', default=None, help='Directory for plates and outputs (default: a temp dir)')
+    parser.add_argument('--scratch', default=None, help='Scratch directory passed to the pipelines (intermediates are deleted when consumed)')
+    parser.add_argument('--verbose', action='store_true', help='Show the pipeline console output')
+    parser.add_argument('--json', default=None, help='Write the results as JSON to this file')
+    args = parser.parse_args()
+    cleanup = args.workdir is None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='migseq_bench_'))
+    try:
+        bindir = stubs.install(os.path.join(args.workdir, 'bin'))
+        results = [bench_size(args, int(n), bindir) for n in args.sizes.split(',')]
+        print_table(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+    finally:
+        if cleanup:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# Lightweight stand-ins for the external tools, so the pipelines can be timed
+# without a real sequencing run. Each tool does the minimum I/O needed for the
+# next stage to find its inputs; MIGSEQ_STUB_SLEEP adds a fixed delay per call.
+#
+#   python bench/stubs.py install <bindir>   # write fastp, bwa, ... wrappers
+import gzip
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import time
+
+
+TOOLS = [
+    'fastp', 'bwa', 'samtools', 'denovo_map.pl', 'ustacks', 'cstacks', 'sstacks',
+    'tsv2bam', 'gstacks', 'populations', 'iqtree2']
+
+
+def option(args, *names, default=None):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return default
+
+
+def count_fastq(path):
+    with gzip.open(path, 'rb') as f:
+        return sum(1 for _ in f) // 4
+
+
+def read_popmap(path):
+    with open(path) as f:
+        return [line.split('\t')[0] for line in f if line.strip() and not line.startswith('#')]
+
+
+def write_phylip(path, samples, n_sites=200, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write(f'{len(samples)} {n_sites}\n')
+        for sample in samples:
+            seq = ''.join(rng.choice('ACGTN') for _ in range(n_sites))
+            f.write(f'{sample}\t{seq}\n')
+        f.write('# Stacks stub\n')
+
+
+def write_vcf(path, samples, n_loci=200, seed=0):
+    rng = random.Random(seed)
+    genotypes = ['0/0', '0/1', '1/1', './.']
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(samples) + '\n')
+        for i in range(n_loci):
+            calls = '\t'.join(rng.choice(genotypes) for _ in samples)
+            f.write(f'{i + 1}\t10\t{i + 1}:10:+\tA\tG\t.\tPASS\t.\tGT\t{calls}\n')
+
+
+def populations_outputs(outdir, popmap):
+    samples = read_popmap(popmap)
+    write_phylip(os.path.join(outdir, 'populations.fixed.phylip'), samples)
+    write_vcf(os.path.join(outdir, 'populations.snps.vcf'), samples)
+    with open(os.path.join(outdir, 'populations.log'), 'w') as f:
+        f.write('Kept 200 loci, composed of 40000 sites; 39800 of those sites were filtered, 200 variant sites remained.\n')
+
+
+def fastp(args):
+    if '--version' in args:
+        sys.stderr.write('fastp 0.0.0-stub\n')
+        return 0
+    reads = {}
+    for src_opt, dst_opt in (('-i', '-o'), ('-I', '-O')):
+        shutil.copyfile(option(args, src_opt), option(args, dst_opt))
+        reads[src_opt] = count_fastq(option(args, src_opt))
+    total = reads['-i'] + reads['-I']
+    summary = {'total_reads': total, 'total_bases': total * 100, 'q30_rate': 0.95}
+    report = {
+        'summary': {'before_filtering': summary, 'after_filtering': summary},
+        'filtering_result': {'passed_filter_reads': total, 'low_quality_reads': 0, 'too_short_reads': 0},
+        'duplication': {'rate': 0.1},
+        'insert_size': {'peak': 150},
+    }
+    with open(option(args, '--json'), 'w') as f:
+        json.dump(report, f)
+    with open(option(args, '--html'), 'w') as f:
+        f.write('<html></html>\n')
+    return 0
+
+
+def bwa(args):
+    if not args:
+        sys.stderr.write('Program: bwa (stub)\nVersion: 0.0.0-stub\n')
+        return 1
+    if args[0] == 'index':
+        for ext in ('amb', 'ann', 'bwt', 'pac', 'sa'):
+            open(f'{args[-1]}.{ext}', 'w').close()
+        return 0
+    # mem [-t N] ref r1 r2: emit a header and every read pair as a proper pair
+    # on the first reference sequence
+    ref, r1, r2 = args[-3:]
+    out = sys.stdout
+    out.write('@HD\tVN:1.6\tSO:unsorted\n')
+    contigs = []
+    with open(ref) as f:
+        for line in f:
+            if line.startswith('>'):
+                contigs.append(line[1:].split()[0])
+                out.write(f'@SQ\tSN:{contigs[-1]}\tLN:200\n')
+    rname = contigs[0] if contigs else '*'
+    with gzip.open(r1, 'rt') as f1, gzip.open(r2, 'rt') as f2:
+        for head1, head2 in zip(f1, f2):
+            seq1, seq2 = next(f1).strip(), next(f2).strip()
+            next(f1), next(f2)
+            qual1, qual2 = next(f1).strip(), next(f2).strip()
+            name = head1[1:].split()[0]
+            out.write(f'{name}\t99\t{rname}\t1\t60\t{len(seq1)}M\t=\t1\t0\t{seq1}\t{qual1}\n')
+            out.write(f'{name}\t147\t{rname}\t1\t60\t{len(seq2)}M\t=\t1\t0\t{seq2}\t{qual2}\n')
+    return 0
+
+
+def samtools(args):
+    if args[:1] == ['--version']:
+        print('samtools 0.0.0-stub')
+        return 0
+    if args[0] == 'sort':
+        # stand-in "BAM": the SAM stream copied as-is
+        with open(option(args, '-o'), 'wb') as out:
+            shutil.copyfileobj(sys.stdin.buffer, out)
+        return 0
+    if args[0] in ('index', 'faidx'):
+        open(args[-1] + ('.bai' if args[0] == 'index' else '.fai'), 'w').close()
+        return 0
+    if args[0] == 'dict':
+        open(option(args, '-o'), 'w').close()
+        return 0
+    if args[0] in ('flagstat', 'view'):
+        # the stand-in "BAM" is SAM text: flagstat -O tsv and view -c [-F mask] [-q mapq]
+        mask = int(option(args, '-F', default='0'), 0)
+        min_mapq = int(option(args, '-q', default='0'))
+        counts = dict.fromkeys(['total', 'primary', 'mapped', 'primary mapped', 'properly paired', 'view'], 0)
+        with open(args[-1]) as f:
+            for line in f:
+                if line.startswith('@'):
+                    continue
+                fields = line.split('\t', 5)
+                flag = int(fields[1])
+                primary = not flag & 0x900
+                mapped = not flag & 0x4
+                counts['total'] += 1
+                counts['primary'] += primary
+                counts['mapped'] += mapped
+                counts['primary mapped'] += primary and mapped
+                counts['properly paired'] += primary and mapped and bool(flag & 0x2)
+                counts['view'] += not flag & mask and int(fields[4]) >= min_mapq
+        if args[0] == 'view':
+            print(counts['view'])
+            return 0
+        print(f"{counts['total']}\t0\tin total (QC-passed reads + QC-failed reads)")
+        for name in ('primary', 'mapped', 'primary mapped', 'properly paired'):
+            print(f'{counts[name]}\t0\t{name}')
+        return 0
+    return 0
+
+
+def denovo_map(args):
+    if '--version' in args:
+        print('denovo_map.pl 0.0.0-stub')
+        return 0
+    outdir = option(args, '-o')
+    os.makedirs(outdir, exist_ok=True)
+    popmap = option(args, '--popmap')
+    for name in ('catalog.tags.tsv.gz', 'catalog.fa.gz', 'catalog.calls', 'denovo_map.log'):
+        open(os.path.join(outdir, name), 'w').close()
+    for sample in read_popmap(popmap):
+        open(os.path.join(outdir, f'{sample}.tags.tsv.gz'), 'w').close()
+    populations_outputs(outdir, popmap)
+    return 0
+
+
+def stacks_step(tool):
+    # ustacks/cstacks/sstacks/tsv2bam as used by the incremental mode: one empty
+    # file per output, named as the real tool names it
+    def run(args):
+        if '--version' in args:
+            print(f'{tool} 0.0.0-stub')
+            return 0
+        if tool == 'ustacks':
+            outputs = [os.path.join(option(args, '-o'), f"{option(args, '--name')}.tags.tsv.gz")]
+        elif tool == 'cstacks':
+            outputs = [os.path.join(option(args, '-o'), 'catalog.tags.tsv.gz')]
+        elif tool == 'sstacks':
+            outputs = [option(args, '-s') + '.matches.tsv.gz']
+        else:
+            outputs = [os.path.join(option(args, '-P'), f"{option(args, '-s')}.matches.bam")]
+        for path in outputs:
+            open(path, 'w').close()
+        return 0
+    return run
+
+
+def gstacks(args):
+    if '--version' in args:
+        print('gstacks 0.0.0-stub')
+        return 0
+    outdir = option(args, '-O', '-P')
+    for name in ('catalog.fa.gz', 'catalog.calls', 'gstacks.log'):
+        open(os.path.join(outdir, name), 'w').close()
+    return 0
+
+
+def populations(args):
+    if '--version' in args:
+        print('populations 0.0.0-stub')
+        return 0
+    outdir = option(args, '-O', default=option(args, '-P'))
+    os.makedirs(outdir, exist_ok=True)
+    populations_outputs(outdir, option(args, '-M'))
+    return 0
+
+
+def iqtree2(args):
+    if '--version' in args:
+        print('IQ-TREE multicore version 0.0.0-stub')
+        return 0
+    prefix = option(args, '-pre', '--prefix')
+    with open(option(args, '-s')) as f:
+        names = [line.split()[0] for line in list(f)[1:] if line.strip()]
+    with open(f'{prefix}.treefile', 'w') as f:
+        f.write('(' + ','.join(names) + ');\n')
+    with open(f'{prefix}.iqtree', 'w') as f:
+        f.write('Best-fit model according to BIC: GTR+F+ASC\n')
+        # a different likelihood per seed so the multi-seed pick has something to choose
+        loglik = -1000.0 - int(option(args, '-seed', default=0)) * 7 % 5
+        f.write(f'Log-likelihood of the tree: {loglik:.4f} (s.e. 10.0)\n')
+    with open(f'{prefix}.log', 'w') as f:
+        f.write('BEST SCORE FOUND : -1000.000\n')
+    return 0
+
+
+def install(bindir):
+    # write one small wrapper per tool into bindir and return its path
+    os.makedirs(bindir, exist_ok=True)
+    here = os.path.abspath(__file__)
+    for tool in TOOLS:
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{here}" {tool} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bindir
+
+
+def main(argv):
+    tool, args = argv[0], argv[1:]
+    if tool == 'install':
+        print(install(args[0]))
+        return 0
+    delay = float(os.environ.get('MIGSEQ_STUB_SLEEP', 0))
+    if delay:
+        time.sleep(delay)
+    handlers = {
+        'fastp': fastp, 'bwa': bwa, 'samtools': samtools,
+        'denovo_map.pl': denovo_map, 'gstacks': gstacks,
+        'ustacks': stacks_step('ustacks'), 'cstacks': stacks_step('cstacks'),
+        'sstacks': stacks_step('sstacks'), 'tsv2bam': stacks_step('tsv2bam'),
+        'populations': populations, 'iqtree2': iqtree2,
+    }
+    return handlers[tool](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,3 @@
+# Migseq2：MIG-seq数据的denovo和mapping分析流程
+# 这里不导入任何子模块，`migseq2 --help`和各子命令只加载自己用到的部分
+__version__ = '2.0.0'
@@ -0,0 +1,5 @@
+import sys
+
+from migseq2.cli import main
+
+sys.exit(main())
@@ -0,0 +1,131 @@
+# 两个流程共用的比对矩阵处理模块（IQ-TREE之前）
+# PHYLIP比对以uint8矩阵（样本 x 位点）保存，较大时放在内存映射文件中；
+# 缺失率、不变位点和重复序列都按位点块向量化计算，内存占用与位点数无关
+import tempfile
+
+import numpy as np
+
+
+MMAP_BYTES = 1 << 30  # 矩阵超过该大小时使用内存映射文件
+SITE_BLOCK = 1 << 16  # 每次处理的位点数
+MISSING = b'N-?'  # 缺失字符
+
+# IUPAC字符 -> 4位碱基集合（A=1, C=2, G=4, T=8），缺失为全部4种碱基
+BASE_MASK = np.zeros(256, dtype=np.uint8)
+for _codes, _mask in (
+        ('A', 1), ('C', 2), ('G', 4), ('T', 8), ('U', 8),
+        ('R', 5), ('Y', 10), ('S', 6), ('W', 9), ('K', 12), ('M', 3),
+        ('B', 14), ('D', 13), ('H', 11), ('V', 7), ('N-?', 15)):
+    for _code in _codes:
+        BASE_MASK[ord(_code)] = BASE_MASK[ord(_code.lower())] = _mask
+IS_MISSING = np.zeros(256, dtype=bool)
+IS_MISSING[list(MISSING + MISSING.lower())] = True
+
+
+def load_phylip(path, workdir=None, mmap_bytes=MMAP_BYTES):
+    # 读取顺序格式的PHYLIP（每个样本一行，忽略#注释行），返回 (样本名列表, uint8矩阵)
+    # 矩阵超过mmap_bytes时写入workdir中的临时内存映射文件（文件在打开后即删除）
+    with open(path, 'rb') as f:
+        n_samples, n_sites = (int(v) for v in f.readline().split()[:2])
+        if n_samples * n_sites > mmap_bytes:
+            with tempfile.NamedTemporaryFile(dir=workdir, suffix='.phylip.u8') as tmp:
+                matrix = np.memmap(tmp.name, dtype=np.uint8, mode='w+', shape=(n_samples, n_sites))
+        else:
+            matrix = np.empty((n_samples, n_sites), dtype=np.uint8)
+        names = []
+        for line in f:
+            if not line.strip() or line.lstrip().startswith(b'#'):
+                continue
+            name, seq = line.split(None, 1)
+            seq = b''.join(seq.split())
+            if len(names) >= n_samples or len(seq) != n_sites:
+                raise ValueError(f"'{path}' 与标题行的样本数或位点数 ({n_samples} {n_sites}) 不一致。")
+            matrix[len(names)] = np.frombuffer(seq, dtype=np.uint8)
+            names.append(name.decode())
+    if len(names) != n_samples:
+        raise ValueError(f"'{path}' 只有 {len(names)} 个样本，标题行为 {n_samples}。")
+    return names, matrix
+
+
+def site_blocks(n_sites, block=SITE_BLOCK):
+    for start in range(0, n_sites, block):
+        yield slice(start, min(start + block, n_sites))
+
+
+def missingness(matrix, rows, block=SITE_BLOCK):
+    # rows中每个样本的缺失位点数，以及每个位点在rows中的缺失样本数
+    per_sample = np.zeros(len(rows), dtype=np.int64)
+    per_site = np.zeros(matrix.shape[1], dtype=np.int64)
+    for cols in site_blocks(matrix.shape[1], block):
+        missing = IS_MISSING[matrix[rows, cols]]
+        per_sample += missing.sum(axis=1)
+        per_site[cols] = missing.sum(axis=0)
+    return per_sample, per_site
+
+
+def variable_sites(matrix, rows, block=SITE_BLOCK):
+    # 位点在rows中是否可变：所有非缺失字符的碱基集合没有共同碱基
+    # （与IQ-TREE的+ASC一致，A和R这样相容的模糊碱基也算不变）
+    variable = np.zeros(matrix.shape[1], dtype=bool)
+    for cols in site_blocks(matrix.shape[1], block):
+        common = np.bitwise_and.reduce(BASE_MASK[matrix[rows, cols]], axis=0)
+        variable[cols] = common == 0
+    return variable
+
+
+def duplicate_rows(matrix, rows, cols):
+    # 在保留的位点上序列完全相同的样本：{重复样本行: 第一次出现的样本行}
+    seen = {}
+    duplicates = {}
+    for row in rows:
+        seq = matrix[row, cols].tobytes()
+        if seq in seen:
+            duplicates[row] = seen[seq]
+        else:
+            seen[seq] = row
+    return duplicates
+
+
+def write_phylip(path, names, matrix, rows, cols):
+    with open(path, 'wb') as f:
+        f.write(f'{len(rows)} {len(cols)}\n'.encode())
+        for row in rows:
+            f.write(names[row].encode() + b'\t' + matrix[row, cols].tobytes() + b'\n')
+
+
+def filter_alignment(names, matrix, outfile, report, max_sample_missing=1.0,
+                     max_site_missing=1.0, keep_invariant=False, dedupe=False):
+    # 依次去掉缺失率超过阈值的样本、缺失率超过阈值的位点、不变位点和（可选）重复序列，
+    # 写出较小的PHYLIP和每个样本的报告（report，TSV），返回位点和样本的计数
+    n_samples, n_sites = matrix.shape
+    all_rows = np.arange(n_samples)
+    sample_missing, _ = missingness(matrix, all_rows)
+    sample_frac = sample_missing / max(n_sites, 1)
+    status = ['kept'] * n_samples
+    for row in np.flatnonzero(sample_frac > max_sample_missing):
+        status[row] = 'missing'
+    rows = np.flatnonzero(sample_frac <= max_sample_missing)
+    _, site_missing = missingness(matrix, rows)
+    keep = site_missing <= max_site_missing * len(rows)
+    dropped_missing = int(n_sites - keep.sum())
+    dropped_invariant = 0
+    if not keep_invariant:
+        variable = variable_sites(matrix, rows)
+        dropped_invariant = int((keep & ~variable).sum())
+        keep &= variable
+    cols = np.flatnonzero(keep)
+    if dedupe:
+        duplicates = duplicate_rows(matrix, rows, cols)
+        for row, first in duplicates.items():
+            status[row] = f'duplicate:{names[first]}'
+        rows = np.array([row for row in rows if row not in duplicates], dtype=np.int64)
+    write_phylip(outfile, names, matrix, rows, cols)
+    with open(report, 'w') as f:
+        f.write('sample\tmissing_sites\tmissing_frac\tstatus\n')
+        for row in all_rows:
+            f.write(f'{names[row]}\t{sample_missing[row]}\t{sample_frac[row]:.4f}\t{status[row]}\n')
+    return {
+        'samples': n_samples, 'kept_samples': len(rows),
+        'sites': n_sites, 'kept_sites': len(cols),
+        'missing_sites': dropped_missing, 'invariant_sites': dropped_invariant,
+    }
@@ -0,0 +1,38 @@
+# 命令行入口：migseq2 denovo|mapping|plan [选项]
+# 子命令的模块在选定后才导入，--help和--version不加载任何流程代码
+import argparse
+import importlib
+import sys
+
+from migseq2 import __version__
+
+
+# 子命令 -> (模块, 说明)
+PIPELINES = {
+    'denovo': ('migseq2.denovo', 'de novo pipeline: fastp, Stacks denovo_map.pl, IQ-TREE'),
+    'mapping': ('migseq2.mapping', 'reference mapping pipeline: fastp, bwa mem, Stacks gstacks/populations, IQ-TREE'),
+    'plan': ('migseq2.history', 'predict per-stage wall time and peak work-directory usage of a run from the run history'),
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='migseq2', description='MIG-seq analysis pipelines',
+        epilog='Run "migseq2 <pipeline> --help" for the options of each pipeline.')
+    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
+    commands = parser.add_subparsers(dest='pipeline', metavar='pipeline')
+    for name, (_, help_text) in PIPELINES.items():
+        commands.add_parser(name, help=help_text, add_help=False)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in PIPELINES:
+        # 选项交给子命令自己的解析器，只导入该子命令的模块
+        module = importlib.import_module(PIPELINES[argv[0]][0])
+        return module.main(argv[1:], prog=f'migseq2 {argv[0]}')
+    parser = get_parser()
+    parser.parse_args(argv)
+    parser.print_help()
+    return 1
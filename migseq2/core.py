@@ -0,0 +1,1256 @@
+# denovo和mapping两个流程共用的核心：样本清单、CPU调度、阶段缓存、中间文件保留策略、运行指标，
+# 以及按样本执行阶段链的Pipeline基类
+# 这里只导入标准库；cProfile和依赖numpy的migseq2.align/migseq2.vcf在用到时才导入，
+# 使--from_fa/--from_bam这样的短任务启动更快
+import csv
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from subprocess import PIPE
+
+from migseq2.fastx import concat_gzip
+
+
+LOG_TAIL_LINES = 50  # 内存中保留的命令输出行数
+PROGRESS_INTERVAL = 30  # 控制台进度输出的间隔（秒）
+
+
+SAMPLE_MANIFEST = 'samples.tsv'  # outdir中的样本清单
+MANIFEST_COLUMNS = ('sample', 'r1', 'r2', 'lanes', 'input_bytes')
+# Illumina命名：{样本}_L00N_R1_001.fastq.gz，样本名保留_S编号
+FASTQ_NAME = re.compile(
+    r'^(?P<sample>.+)_L(?P<lane>\d{3})_R(?P<read>[12])_(?P<chunk>\d{3})\.f(?:ast)?q\.gz$')
+
+
+def discover_fastq(indir):
+    # 递归扫描indir下的所有运行目录，按样本收集各lane的R1/R2文件
+    # 返回 {样本: (R1列表, R2列表)}，路径相对于indir，按目录、lane和分块排序
+    units = {}
+    for root, dirs, files in os.walk(indir, followlinks=True):
+        dirs.sort()
+        for name in files:
+            match = FASTQ_NAME.match(name)
+            if match is None:
+                continue
+            rel = os.path.relpath(os.path.join(root, name), indir)
+            unit = (os.path.dirname(rel), match['lane'], match['chunk'])
+            units.setdefault(match['sample'], {}).setdefault(unit, {})[match['read']] = rel
+    samples = {}
+    for sample, found in units.items():
+        r1, r2 = [], []
+        for unit in sorted(found):
+            reads = found[unit]
+            if '1' not in reads or '2' not in reads:
+                raise FileNotFoundError(
+                    f"样本 '{sample}' 的 {reads.get('1') or reads.get('2')} 缺少配对的R1/R2文件。")
+            r1.append(reads['1'])
+            r2.append(reads['2'])
+        samples[sample] = (r1, r2)
+    return samples
+
+
+def write_manifest(path, samples, indir):
+    # 写出制表符分隔的样本清单；同一样本的多个lane文件以逗号分隔
+    # 临时文件名带进程号：并行的分片可能同时写出同一份清单
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(MANIFEST_COLUMNS)
+        for sample in sorted(samples):
+            r1, r2 = samples[sample]
+            size = sum(os.path.getsize(os.path.join(indir, fq)) for fq in r1 + r2)
+            writer.writerow([sample, ','.join(r1), ','.join(r2), len(r1), size])
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    # 读取样本清单并检查列、配对和类型
+    # 返回 {样本: {'r1': [...], 'r2': [...], 'lanes': int, 'input_bytes': int}}
+    rows = {}
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        missing = [c for c in MANIFEST_COLUMNS[:3] if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"样本清单 '{path}' 缺少列: {', '.join(missing)}")
+        for lineno, row in enumerate(reader, start=2):
+            sample = (row['sample'] or '').strip()
+            if not sample or sample.startswith('#'):
+                continue
+            if sample in rows:
+                raise ValueError(f"{path}:{lineno}: 样本 '{sample}' 重复。")
+            r1 = [fq.strip() for fq in (row['r1'] or '').split(',') if fq.strip()]
+            r2 = [fq.strip() for fq in (row['r2'] or '').split(',') if fq.strip()]
+            if not r1 or len(r1) != len(r2):
+                raise ValueError(f"{path}:{lineno}: 样本 '{sample}' 的R1和R2文件数不一致。")
+            try:
+                input_bytes = int(row.get('input_bytes') or 0)
+            except ValueError:
+                raise ValueError(
+                    f"{path}:{lineno}: input_bytes不是整数: '{row['input_bytes']}'") from None
+            rows[sample] = {'r1': r1, 'r2': r2, 'lanes': len(r1), 'input_bytes': input_bytes}
+    return rows
+
+
+# 各外部工具的效率曲线：(并行比例p, 最大有效线程数)
+# 预计加速比按Amdahl定律 1 / ((1 - p) + p / n) 计算；fastp大约4线程后不再提速
+TOOL_CURVES = {
+    'fastp': (0.8, 4),
+    'bwa': (0.95, 32),
+    'samtools': (0.9, 8),
+    'bgzf': (0.95, 8),
+    'default': (0.9, None),
+}
+
+
+BACKFILL_WAIT = 30.0  # 最前面的等待者等了这么多秒之后，不再让后面的小任务回填
+
+
+def parse_tool_curves(specs):
+    # 解析 --tool_curve 参数，格式为 tool=p 或 tool=p:max_threads
+    curves = {}
+    for spec in specs or []:
+        tool, _, value = spec.partition('=')
+        p, _, max_threads = value.partition(':')
+        curves[tool.strip()] = (float(p), int(max_threads) if max_threads else None)
+    return curves
+
+
+class CpuScheduler:
+    # 全局CPU预算调度器：给每个外部命令分配线程数，并保证同时占用的线程总数不超过预算
+    def __init__(self, budget, curves=None, backfill_wait=BACKFILL_WAIT):
+        self.budget = max(1, int(budget))
+        self.curves = dict(TOOL_CURVES)
+        if curves:
+            self.curves.update(curves)
+        self.backfill_wait = backfill_wait
+        self._free = self.budget
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def max_threads(self, tool):
+        max_threads = self.curves.get(tool, self.curves['default'])[1]
+        return min(max_threads or self.budget, self.budget)
+
+    def speedup(self, tool, threads):
+        p = self.curves.get(tool, self.curves['default'])[0]
+        return 1.0 / ((1.0 - p) + p / threads)
+
+    def plan(self, tool, n_jobs):
+        # 返回(每个任务的线程数, 同时运行的任务数)，使这一批任务的预计完成时间最短
+        n_jobs = max(1, n_jobs)
+        best = None
+        for threads in range(1, self.max_threads(tool) + 1):
+            slots = min(n_jobs, self.budget // threads)
+            waves = -(-n_jobs // slots)
+            makespan = waves / self.speedup(tool, threads)
+            if best is None or makespan < best[0] - 1e-9:
+                best = (makespan, threads, slots)
+        return best[1], best[2]
+
+    def _can_start(self, ticket):
+        # 按优先级依次检查等待者，第一个放得下的等待者可以开始（允许小任务回填）；
+        # 最前面的等待者等待超过backfill_wait秒后停止回填，空出的线程都留给它，
+        # 源源不断的小任务不会让宽任务（gstacks、populations、IQ-TREE）一直等下去
+        waiting = sorted(self._waiting)
+        head, threads, since = waiting[0]
+        if threads <= self._free:
+            return head == ticket
+        if time.monotonic() - since > self.backfill_wait:
+            return False
+        for waiting_ticket, threads, _ in waiting[1:]:
+            if threads <= self._free:
+                return waiting_ticket == ticket
+        return False
+
+    @contextmanager
+    def reserve(self, threads, priority=0):
+        # 占用threads个线程，预算不足时阻塞等待；空出的线程优先分给priority小的任务
+        threads = min(max(1, threads), self.budget)
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            entry = (ticket, threads, time.monotonic())
+            self._waiting.append(entry)
+            while not self._can_start(ticket):
+                self._cond.wait()
+            self._waiting.remove(entry)
+            self._free -= threads
+            self._cond.notify_all()
+        try:
+            yield threads
+        finally:
+            with self._cond:
+                self._free += threads
+                self._cond.notify_all()
+
+
+SHARD_DIR = 'shards'  # outdir中各分片的状态目录 shards/{编号}/
+SHARD_MARKER = 'done.json'  # 分片的样本级阶段全部成功后最后写出的完成标记
+# 作业数组的任务编号环境变量，以及第一个任务的编号（Slurm按SLURM_ARRAY_TASK_MIN换算）
+SHARD_ENV = (('PBS_ARRAY_INDEX', 0), ('PBS_ARRAYID', 0), ('SGE_TASK_ID', 1), ('LSB_JOBINDEX', 1))
+
+
+def shard_index_from_env(environ=os.environ):
+    # 作业数组的任务编号换算成从0开始的分片编号；不在作业数组中时返回None
+    if environ.get('SLURM_ARRAY_TASK_ID', '').isdigit():
+        return int(environ['SLURM_ARRAY_TASK_ID']) - int(environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    for name, first in SHARD_ENV:
+        # SGE在非数组作业中把SGE_TASK_ID设为undefined
+        if environ.get(name, '').isdigit():
+            return int(environ[name]) - first
+    return None
+
+
+def assign_shards(sizes, count):
+    # LPT分配：样本按输入大小从大到小，依次分给当前总大小最小的分片
+    # 结果只取决于样本清单，各分片和汇总步骤各自计算得到同样的分配
+    loads = [(0, index) for index in range(count)]
+    shards = [[] for _ in range(count)]
+    for sample in sorted(sizes, key=lambda sample: (-sizes[sample], sample)):
+        load, index = heapq.heappop(loads)
+        shards[index].append(sample)
+        heapq.heappush(loads, (load + sizes[sample], index))
+    return shards
+
+
+def manifest_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def run_local_shards(pipeline, argv, count):
+    # 在本机把count个分片作为并行的子进程运行（提交作业数组之前测试分片设置），全部成功后返回
+    argv = [arg for arg in argv if arg not in ('--local_shards', '--gather')]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    procs = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'migseq2', pipeline] + argv + ['--shard_index', str(index)],
+            env=env)
+        for index in range(count)]
+    failed = [str(index) for index, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f"分片运行失败: {', '.join(failed)}")
+
+
+# -m为这些模型选择时先单独运行ModelFinder（结果按比对和选项缓存），树搜索直接使用选出的模型
+MODEL_SELECTION = {'MFP': 'MF', 'TEST': 'TESTONLY', 'TESTNEW': 'TESTNEWONLY'}
+IQ_SEEDS = 'iq_seeds.tsv'  # 多个种子的对数似然和选出的树
+
+
+def read_iqtree_report(path):
+    # 从IQ-TREE的.iqtree报告中取出选出的模型和树的对数似然（没有时为None）
+    model = loglik = None
+    with open(path) as f:
+        for line in f:
+            if line.startswith('Best-fit model according to'):
+                model = line.split(':', 1)[1].strip()
+            elif line.startswith('Log-likelihood of the tree:'):
+                loglik = float(line.split(':', 1)[1].split()[0])
+    return model, loglik
+
+
+MANIFEST_NAME = 'stage_manifest.json'  # outdir中的阶段缓存清单
+JOURNAL_SUFFIX = '.journal'  # 清单旁逐项追加记录的JSONL日志，阶段结束时并入清单
+FINGERPRINT_BLOCK = 1 << 16  # 文件指纹读取的首尾字节数
+
+
+def file_fingerprint(path, block=FINGERPRINT_BLOCK):
+    # 输入文件指纹：文件大小 + 首尾各block字节内容的sha256
+    # 不完整读取几十GB的原始数据，原始FASTQ一般不会原地修改；block为None时对全部内容计算
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        if block is None:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        elif size <= 2 * block:
+            h.update(f.read())
+        else:
+            h.update(f.read(block))
+            f.seek(-block, os.SEEK_END)
+            h.update(f.read(block))
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(cmd):
+    # 工具版本输出（作为缓存键的一部分），同一次运行中只查询一次
+    try:
+        proc = subprocess.run(
+            cmd, shell=True, stdout=PIPE, stderr=subprocess.STDOUT,
+            text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return ''
+    return proc.stdout.strip()
+
+
+class StageCache:
+    # 内容寻址的阶段缓存：记录每个阶段（及每个样本）的输入、参数和工具版本的哈希
+    # 键没有变化且输出文件仍然存在时跳过该阶段；每完成一项就在日志末尾追加一行（不重写整个清单），
+    # 阶段结束时把日志并入清单；崩溃后加载时重放日志，可以续跑
+    def __init__(self, outdir, force=False):
+        self.path = os.path.join(outdir, MANIFEST_NAME)
+        self.journal = self.path + JOURNAL_SUFFIX
+        self.force = force
+        self.entries = {}
+        self.hits = 0  # 本次运行中命中的次数（运行历史只用没有命中的运行做预测）
+        self._lock = threading.Lock()
+        self._journal = None  # 追加日志的文件对象，第一次记录时打开
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        if os.path.exists(self.journal):
+            self._replay()
+            self.compact()
+
+    def key(self, stage, params, inputs=(), upstream=(), full=False):
+        # inputs为需要计算指纹的文件，upstream为上游阶段的键
+        # full为True时对inputs的全部内容计算哈希（比对等较小、可能只改变中间部分的文件）
+        block = None if full else FINGERPRINT_BLOCK
+        payload = {
+            'stage': stage,
+            'params': params,
+            'inputs': [file_fingerprint(p, block) for p in inputs],
+            'upstream': list(upstream),
+        }
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def hit(self, stage, item, key, released=False):
+        # 命中时返回记录的输出文件列表，否则返回None
+        # released为True时，已被保留策略删除的输出也算命中（下游需要时再重新生成）
+        if self.force:
+            return None
+        entry = self.entries.get(stage, {}).get(item)
+        if entry is None or entry['key'] != key:
+            return None
+        if not (released and entry.get('released')) and not all(
+                os.path.exists(p) for p in entry['outputs']):
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry['outputs']
+
+    def meta(self, stage, item):
+        # 与输出一起记录的附加数据（如读段计数）
+        return self.entries.get(stage, {}).get(item, {}).get('meta')
+
+    def record(self, stage, item, key, outputs, meta=None):
+        with self._lock:
+            entry = {'key': key, 'outputs': list(outputs), 'time': time.time()}
+            if meta is not None:
+                entry['meta'] = meta
+            self.entries.setdefault(stage, {})[item] = entry
+            self._append({'stage': stage, 'item': item, 'entry': entry})
+
+    def merge(self, entries):
+        # 并入另一份清单（分片的阶段缓存）中的记录
+        with self._lock:
+            for stage, items in entries.items():
+                self.entries.setdefault(stage, {}).update(items)
+            self._fold()
+
+    def release(self, stage, item):
+        # 输出文件已被删除，但键仍然有效
+        with self._lock:
+            entry = self.entries.get(stage, {}).get(item)
+            if entry is None:
+                return
+            entry['released'] = True
+            self._append({'stage': stage, 'item': item, 'released': True})
+
+    def compact(self):
+        # 把日志并入清单（阶段结束时调用）；没有新记录时不写文件
+        with self._lock:
+            if self._journal is not None or os.path.exists(self.journal):
+                self._fold()
+
+    def _append(self, record):
+        if self._journal is None:
+            self._journal = open(self.journal, 'a')
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+
+    def _replay(self):
+        # 按顺序重放日志；崩溃时写了一半的最后一行忽略（该项下次重新运行）
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                items = self.entries.setdefault(record['stage'], {})
+                if 'entry' in record:
+                    items[record['item']] = record['entry']
+                elif record['item'] in items:
+                    items[record['item']]['released'] = True
+
+    def _fold(self):
+        # 先写出完整的清单再删除日志：两步之间崩溃时，重放日志得到同样的记录
+        self._save()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class Retention:
+    # 中间文件的保留策略：登记每个产物（阶段+样本）由哪些阶段消费，
+    # 最后一个消费阶段完成后立即删除，并在阶段缓存中标记为已释放
+    def __init__(self, cache, enabled=False):
+        self.cache = cache
+        self.enabled = enabled
+        self.pending = {}
+        self.freed_bytes = 0
+        self._lock = threading.Lock()
+
+    def produce(self, stage, item, files, consumers):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.pending[(stage, item)] = (list(files), set(consumers))
+
+    def consume(self, stage, item, consumer):
+        # consumer阶段已经用完stage在item上的产物
+        with self._lock:
+            entry = self.pending.get((stage, item))
+            if entry is None:
+                return
+            entry[1].discard(consumer)
+            if entry[1]:
+                return
+            del self.pending[(stage, item)]
+        self._delete(stage, item, entry[0])
+
+    def release_all(self):
+        # 运行结束时删除剩余的中间文件（用于清空scratch）
+        with self._lock:
+            pending = list(self.pending.items())
+            self.pending.clear()
+        for (stage, item), (files, _) in pending:
+            self._delete(stage, item, files)
+
+    def _delete(self, stage, item, files):
+        for path in files:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self.freed_bytes += size
+        self.cache.release(stage, item)
+
+
+METRICS_NAME = 'run_metrics.json'  # outdir中的运行指标文件
+
+
+def io_counters():
+    # 本进程实际读写存储的字节数（Linux的/proc/self/io），不可用时返回(0, 0)
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ', 1) for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def timed_call(func, *args):
+    # 在进程池的工作进程中调用func，返回(结果, 墙钟时间, CPU时间)
+    wall = time.time()
+    cpu = time.process_time()
+    result = func(*args)
+    return result, time.time() - wall, time.process_time() - cpu
+
+
+class RunMetrics:
+    # 运行指标：每个阶段、每条外部命令和每个样本的墙钟时间、CPU时间、峰值RSS和读写字节数
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.stages = []
+        self.commands = []
+        self.samples = {}
+        self.sample_order = []
+        self.storage = {}
+        self._lock = threading.Lock()
+
+    def add_command(self, stage, sample, cmd, wall, rusage, returncode):
+        # rusage来自wait4，包含shell及其所有已回收子进程
+        record = {
+            'stage': stage, 'sample': sample, 'cmd': cmd,
+            'wall': wall,
+            'cpu_user': rusage.ru_utime, 'cpu_sys': rusage.ru_stime,
+            'peak_rss_kb': rusage.ru_maxrss,
+            'read_bytes': rusage.ru_inblock * 512,
+            'write_bytes': rusage.ru_oublock * 512,
+            'returncode': returncode,
+        }
+        with self._lock:
+            self.commands.append(record)
+        if sample is not None:
+            self.add_sample(
+                stage, sample, wall=wall, cpu=rusage.ru_utime + rusage.ru_stime,
+                peak_rss_kb=rusage.ru_maxrss, read_bytes=record['read_bytes'],
+                write_bytes=record['write_bytes'])
+
+    def add_sample(self, stage, sample, **values):
+        # 按样本累计：peak_rss_kb取最大值，其余数值求和
+        with self._lock:
+            entry = self.samples.setdefault(sample, {}).setdefault(stage, {})
+            for name, value in values.items():
+                if name == 'peak_rss_kb':
+                    entry[name] = max(entry.get(name, 0), value)
+                else:
+                    entry[name] = entry.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.time()
+        self_ru = resource.getrusage(resource.RUSAGE_SELF)
+        child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io = io_counters()
+        first_cmd = len(self.commands)
+        try:
+            yield
+        finally:
+            self_end = resource.getrusage(resource.RUSAGE_SELF)
+            child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io_end = io_counters()
+            with self._lock:
+                cmds = self.commands[first_cmd:]
+            peak_child = max([c['peak_rss_kb'] for c in cmds], default=0)
+            if child_end.ru_maxrss > child_ru.ru_maxrss:
+                peak_child = max(peak_child, child_end.ru_maxrss)
+            # ru_maxrss是进程到本阶段结束为止的峰值：在本阶段升高时就是本阶段的峰值，
+            # 否则是本阶段占用的上限（在进程内运行的阶段不能记为0）；peak_rss_self_raised标出是哪一种
+            self.stages.append({
+                'stage': name,
+                'start': wall,
+                'wall': time.time() - wall,
+                'cpu_self': (self_end.ru_utime + self_end.ru_stime
+                             - self_ru.ru_utime - self_ru.ru_stime),
+                'cpu_children': (child_end.ru_utime + child_end.ru_stime
+                                 - child_ru.ru_utime - child_ru.ru_stime),
+                'peak_rss_self_kb': self_end.ru_maxrss,
+                'peak_rss_self_raised': self_end.ru_maxrss > self_ru.ru_maxrss,
+                'peak_rss_children_kb': peak_child,
+                'read_bytes': (io_end[0] - io[0]
+                               + (child_end.ru_inblock - child_ru.ru_inblock) * 512),
+                'write_bytes': (io_end[1] - io[1]
+                                + (child_end.ru_oublock - child_ru.ru_oublock) * 512),
+                'commands': len(cmds),
+            })
+
+    def write(self):
+        report = {
+            'started': self.started,
+            'finished': time.time(),
+            'wall': time.time() - self.started,
+            'stages': self.stages,
+            'sample_order': self.sample_order,
+            'storage': self.storage,
+            'samples': self.samples,
+            'commands': self.commands,
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+HISTORY_ENV = 'MIGSEQ2_HISTORY'  # 运行历史数据库路径的环境变量
+
+
+def history_path(path=None):
+    # --history > 环境变量MIGSEQ2_HISTORY > ~/.migseq2/history.sqlite
+    # 数据库的读写在migseq2.history中，只在记录运行时才导入（sqlite3不计入启动时间）
+    return path or os.environ.get(HISTORY_ENV) or os.path.join(
+        os.path.expanduser('~'), '.migseq2', 'history.sqlite')
+
+
+def disk_usage(path):
+    # 目录下文件实际占用的磁盘字节数
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+class DiskMonitor:
+    # 工作目录占用的峰值：由阶段装饰器在每个阶段结束时调用sample，不在后台定时遍历（outdir可能在网络文件系统上）
+    # 阶段中已被保留策略删除的中间文件按字节数加回，峰值是偏大的估计
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+
+    def sample(self, released=0):
+        self.peak = max(self.peak, disk_usage(self.path) + released)
+        return self.peak
+
+
+def instrumented(func):
+    # 阶段装饰器：记录阶段指标；指定--profile时对Python部分做cProfile，写到 profile/{stage}.prof
+    # 阶段结束后把阶段缓存的日志并入清单；记录运行历史时，再统计一次工作目录的占用
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        freed = self.retention.freed_bytes
+        try:
+            return staged(self, *args, **kwargs)
+        finally:
+            self.cache.compact()
+            if self.disk_monitor is not None:
+                self.disk_monitor.sample(self.retention.freed_bytes - freed)
+
+    def staged(self, *args, **kwargs):
+        with self.metrics.stage(func.__name__):
+            if not self.profile:
+                return func(self, *args, **kwargs)
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, self, *args, **kwargs)
+            finally:
+                profdir = os.path.join(self.outdir, 'profile')
+                os.makedirs(profdir, exist_ok=True)
+                profiler.dump_stats(os.path.join(profdir, f'{func.__name__}.prof'))
+    return wrapper
+
+class Pipeline:
+    # 两个流程共用的部分：日志、运行指标、调度、缓存、样本级阶段链、比对过滤和IQ-TREE
+    # 子类设置stacks_out（Stacks的输出目录）和alignment_file（交给IQ-TREE的比对），
+    # 并实现fastp_consumers和run
+    def __init__(
+            self, indir, outdir, q, F_remove, R_remove, t, min_len, r, pop_opts,
+            fada=None, rada=None, tool_curves=None, force=False, profile=False,
+            manifest=None, scratch=None, cleanup=False, max_sample_missing=1.0,
+            max_site_missing=1.0, keep_invariant=False, dedupe=False, phylip_source='fixed',
+            min_maf=0.0, min_call_rate=0.0, max_obs_het=1.0, shard_index=None, shard_count=0,
+            gather=False, iq_model='MFP+ASC', bootstrap=1000, alrt=1000, iq_seeds=1,
+            history=None, project=None, run_params=None):
+        self.indir = indir  # 输入目录
+        self.outdir = outdir  # 输出目录
+        os.makedirs(outdir, exist_ok=True)  # 创建输出目录
+        self.log = os.path.join(outdir, 'log.txt')  # 日志文件路径
+        self.setup_logger()  # 设置日志记录器
+        # 分片运行：样本清单分成shard_count份，本进程只对第shard_index份运行样本级阶段；
+        # gather为True时检查所有分片的完成标记并运行队列级阶段
+        self.shard_count = shard_count
+        self.gather = gather
+        self.shard_index = None
+        self.shard_dir = None
+        if gather and not shard_count:
+            raise ValueError('汇总分片需要指定分片数（--shard_count）。')
+        if shard_count and not gather:
+            self.shard_index = shard_index_from_env() if shard_index is None else shard_index
+            if self.shard_index is None or not 0 <= self.shard_index < shard_count:
+                raise ValueError(
+                    f'分片编号 {self.shard_index} 无效：请用--shard_index或作业数组指定0到{shard_count - 1}之间的编号。')
+            # 阶段缓存和运行指标按分片分开保存，并行的分片不会互相覆盖
+            self.shard_dir = os.path.join(outdir, SHARD_DIR, str(self.shard_index))
+            os.makedirs(self.shard_dir, exist_ok=True)
+        state_dir = self.shard_dir or outdir
+        self.metrics = RunMetrics(os.path.join(state_dir, METRICS_NAME))  # 运行指标
+        self.profile = profile  # 是否对Python阶段做cProfile
+        self.q = q  # 质量值阈值
+        self.F_remove = F_remove  # 前向读取移除的碱基数
+        self.R_remove = R_remove  # 反向读取移除的碱基数
+        self.fada = fada  # R1接头序列（None时由fastp自动检测）
+        self.rada = rada  # R2接头序列
+        self.t = t  # 线程数
+        self.scheduler = CpuScheduler(t, tool_curves)  # 外部命令共享的CPU预算
+        self.min_len = min_len  # 最小长度阈值
+        self.path_to_bbmap = "/usr/local/src/bbmap"  # BBMap路径
+        self.path_to_bwa = "bwa"  # BWA路径
+        self.path_to_samtools = "samtools"  # Samtools路径
+        self.path_to_IQtree = "iqtree2"  # IQ-TREE路径
+        self.r = r  # r值
+        self.pop_opts = pop_opts  # 种群选项
+        self.stacks_out = outdir  # Stacks输出目录（子类设置）
+        self.alignment_file = os.path.join(outdir, 'pop.phylip')  # 过滤后的比对（子类设置）
+        # IQ-TREE之前的比对过滤：样本/位点缺失率上限、是否保留不变位点、是否去掉重复序列
+        self.max_sample_missing = max_sample_missing
+        self.max_site_missing = max_site_missing
+        self.keep_invariant = keep_invariant
+        self.dedupe = dedupe
+        # 比对的来源（fixed: populations.fixed.phylip，vcf: 过滤后的VCF基因型）和VCF位点的过滤阈值
+        self.phylip_source = phylip_source
+        self.min_maf = min_maf
+        self.min_call_rate = min_call_rate
+        self.max_obs_het = max_obs_het
+        # IQ-TREE的模型、UFBoot/SH-aLRT的重复次数（0为不计算）和并行运行的种子数
+        self.iq_model = iq_model
+        self.bootstrap = bootstrap
+        self.alrt = alrt
+        self.iq_seeds = max(1, iq_seeds)
+        self.cache = StageCache(state_dir, force)  # 阶段缓存清单
+        self.keys = {}  # 每个样本最近一个阶段的缓存键
+        self.pool = None  # run_samples期间共享的进程池
+        self.samples = {}  # 每个样本当前的文件
+        self.sizes = {}  # 每个样本的输入字节数
+        self.rank = {}  # 样本的调度优先级（0为最大的样本）
+        self.ini = manifest  # 样本清单；为None时扫描indir生成
+        self.lanes = {}  # 每个样本各lane的R1/R2文件
+        self.samples_for_analysis = {}  # 通过样本QC、进入Stacks分析的样本
+        # 中间文件目录：指定scratch时放在节点本地存储上，只把最终产物复制回outdir
+        self.scratch = scratch
+        self.workdir = outdir
+        if scratch is not None:
+            # 分片按自己的状态目录取名：共享scratch的分片不会删除彼此的中间文件
+            tag = hashlib.sha256(os.path.abspath(state_dir).encode()).hexdigest()[:12]
+            self.workdir = os.path.join(scratch, f'migseq2-{tag}')
+            os.makedirs(self.workdir, exist_ok=True)
+        # 使用scratch时总是在消费完成后删除中间文件
+        self.retention = Retention(self.cache, enabled=cleanup or scratch is not None)
+        # 运行历史数据库（None为不记录）；项目名默认为输入目录名，
+        # run_params为命令行选项，记录时去掉不影响结果的选项后作为参数键的内容
+        self.history = history
+        self.project = project or os.path.basename(os.path.abspath(indir))
+        self.run_params = run_params or {}
+        self.disk_monitor = None  # 只在阶段边界统计，不启动线程（进程池fork之前不能有其他线程）
+        if history is not None:
+            self.disk_monitor = DiskMonitor(self.workdir)
+        self.sample_steps = []  # 完整的样本级阶段链
+        self.upstream = {}  # 每个样本当前阶段之前的阶段
+        self.restoring = set()  # 正在重新生成已释放产物的样本
+
+    @instrumented
+    def make_sample_ini(self):
+        # 递归扫描输入目录，生成样本清单outdir/samples.tsv
+        samples = discover_fastq(self.indir)
+        if not samples:
+            raise FileNotFoundError(
+                f"在 '{self.indir}' 下没有找到 *_L00N_R1_001.fastq.gz 格式的FASTQ文件。")
+        self.ini = os.path.join(self.outdir, SAMPLE_MANIFEST)
+        write_manifest(self.ini, samples, self.indir)
+        lanes = sum(len(r1) for r1, _ in samples.values())
+        self.logger.info(f"样本清单'{self.ini}'已创建（{len(samples)}个样本，{lanes}个lane）。")
+
+    def setup_logger(self, name=None):
+        # 设置日志记录器
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        # 创建一个文件处理器，记录DEBUG级别以上的消息
+        fh = logging.FileHandler(self.log)
+        fh.setLevel(logging.DEBUG)
+        fh_formatter = logging.Formatter(
+            '[%(asctime)s] %(levelname)s %(filename)s %(funcName)s :\n%(message)s')
+        fh.setFormatter(fh_formatter)
+        # 创建一个流处理器，记录INFO级别以上的消息
+        sh = logging.StreamHandler()
+        sh.setLevel(logging.INFO)
+        sh_formatter = logging.Formatter(
+            '[%(asctime)s] %(levelname)s %(filename)s : %(message)s',
+            '%Y-%m-%d %H:%M:%S')
+        sh.setFormatter(sh_formatter)
+        # 将处理器添加到日志记录器
+        logger.addHandler(fh)
+        logger.addHandler(sh)
+        self.logger = logger
+
+    def execute_cmd(self, cmd, stage, sample=None, shell=True):
+        # 执行命令：输出实时写入 logs/{stage}/{sample}.log，内存中只保留最后若干行
+        # 控制台定期显示最新一行作为进度；返回码非0时抛出CalledProcessError
+        # stage由调用方明确给出（日志目录和运行指标按它归类）
+        logdir = os.path.join(self.outdir, 'logs', stage)
+        os.makedirs(logdir, exist_ok=True)
+        logfile = os.path.join(logdir, f'{sample or stage}.log')
+        label = f'{stage}/{sample}' if sample else stage
+        self.logger.info('[cmd] {}'.format(cmd))
+        tail = deque(maxlen=LOG_TAIL_LINES)
+        with open(logfile, 'w') as log:
+            log.write(f'[cmd] {cmd}\n')
+            log.flush()
+            start = time.time()
+            proc = subprocess.Popen(
+                cmd, shell=shell, stdout=PIPE, stderr=subprocess.STDOUT,
+                executable='/bin/bash' if shell else None)
+            last = time.monotonic()
+            for raw in iter(lambda: proc.stdout.readline(1 << 16), b''):
+                line = raw.decode(errors='replace')
+                log.write(line)
+                tail.append(line)
+                now = time.monotonic()
+                if now - last >= PROGRESS_INTERVAL and line.strip():
+                    self.logger.info(f'[{label}] {line.rstrip()}')
+                    last = now
+            proc.stdout.close()
+            # 用wait4回收子进程，同时取得其CPU时间、峰值RSS和块I/O
+            _, status, rusage = os.wait4(proc.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+            proc.returncode = returncode
+        self.metrics.add_command(stage, sample, cmd, time.time() - start, rusage, returncode)
+        output = ''.join(tail)
+        if returncode != 0:
+            self.logger.error(f'[{label}] 命令失败（返回码{returncode}），完整日志: {logfile}\n{output}')
+            raise subprocess.CalledProcessError(returncode, cmd, output=output)
+        self.logger.debug(f'[{label}] 完成，日志: {logfile}')
+        return output
+
+    def exec_cutadapt_help(self):
+        # 执行cutadapt帮助命令
+        cmd = 'cutadapt --help'
+        self.execute_cmd(cmd, stage='cutadapt_help')
+
+    @instrumented
+    def load_ini(self):
+        # 加载样本清单；相对路径以indir为基准
+        self.samples = {}
+        self.sizes = {}
+        self.lanes = {}
+        for sample, row in read_manifest(self.ini).items():
+            r1 = [os.path.join(self.indir, fq) for fq in row['r1']]
+            r2 = [os.path.join(self.indir, fq) for fq in row['r2']]
+            self.lanes[sample] = (r1, r2)
+            # 单lane样本直接使用原文件，多lane样本在merge_sample中合并
+            self.samples[sample] = [r1[0], r2[0]]
+            self.sizes[sample] = row['input_bytes'] or sum(
+                os.path.getsize(fq) for fq in r1 + r2 if os.path.exists(fq))
+        self.order_samples()
+
+    def order_samples(self):
+        # 按输入大小从大到小排列样本（最长任务优先），避免最大的样本最后才开始拖长尾部
+        # 排名作为调度器的优先级，顺序同时写入运行报告
+        order = sorted(self.samples, key=lambda sample: (-self.sizes.get(sample, 0), sample))
+        self.rank = {sample: i for i, sample in enumerate(order)}
+        self.metrics.sample_order = [
+            {'sample': sample, 'input_bytes': self.sizes.get(sample, 0)} for sample in order]
+
+    def run_samples(self, steps, samples=None):
+        # 按样本组织的执行器：每个样本独立地依次执行steps中的阶段，样本之间没有屏障
+        # 外部命令的并发由调度器的CPU预算控制，Python阶段在共享的进程池中运行
+        # 最大的样本最先提交
+        samples = list(self.samples) if samples is None else samples
+        samples = sorted(samples, key=lambda sample: self.rank.get(sample, 0))
+        self.pool = ProcessPoolExecutor(max_workers=self.t)
+        # 在启动任何线程之前先让进程池fork出工作进程
+        self.pool.submit(int).result()
+        failed = []
+        try:
+            workers = max(1, min(len(samples), 2 * self.t))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(self.run_sample_steps, sample, steps): sample
+                    for sample in samples}
+                for future in as_completed(futures):
+                    sample = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.logger.error(f"处理样本 '{sample}' 时出错: {e}")
+                        failed.append(sample)
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+        # 有样本失败时立即报错，不再拖到Stacks阶段才暴露
+        if failed:
+            raise RuntimeError(f"处理失败的样本: {', '.join(sorted(failed))}")
+
+    def run_sample_steps(self, sample, steps):
+        # 单个样本的阶段链；记录每个阶段在完整阶段链中的上游，供require重新生成输入
+        for i, step in enumerate(steps):
+            if step in self.sample_steps:
+                self.upstream[sample] = self.sample_steps[:self.sample_steps.index(step)]
+            else:
+                self.upstream[sample] = steps[:i]
+            start = time.time()
+            step(sample)
+            self.metrics.add_sample(step.__name__, sample, wall=time.time() - start)
+
+    def require(self, sample, files):
+        # 输入已被保留策略删除时，从原始FASTQ沿阶段链重新生成
+        # （仍然存在的上游产物直接命中缓存）；返回该样本当前的输入文件
+        if all(os.path.exists(f) for f in files):
+            return files
+        steps = self.upstream.get(sample, [])
+        r1, r2 = self.lanes[sample]
+        self.samples[sample] = [r1[0], r2[0]]
+        restoring = sample in self.restoring
+        self.restoring.add(sample)
+        self.logger.info(f"样本 '{sample}' 的中间文件已被删除，重新生成。")
+        try:
+            for i, step in enumerate(steps):
+                self.upstream[sample] = steps[:i]
+                step(sample)
+        finally:
+            self.upstream[sample] = steps
+            if not restoring:
+                self.restoring.discard(sample)
+        for f in self.samples[sample]:
+            if not os.path.exists(f):
+                raise FileNotFoundError(f"输入文件 '{f}' 不存在。")
+        return self.samples[sample]
+
+    def restore_sample(self, sample):
+        # 队列级阶段需要时，重新生成样本阶段链的最终产物
+        self.upstream[sample] = self.sample_steps
+        self.require(sample, self.samples[sample])
+
+    def require_samples(self, samples):
+        missing = [
+            sample for sample in samples
+            if not all(os.path.exists(f) for f in self.samples[sample])]
+        if missing:
+            self.run_samples([self.restore_sample], samples=missing)
+
+    def keep_final(self, files, subdir):
+        # 使用scratch时把最终产物复制回outdir（已存在且相同的跳过）
+        if self.workdir == self.outdir:
+            return files
+        dest = os.path.join(self.outdir, subdir)
+        os.makedirs(dest, exist_ok=True)
+        copied = []
+        for path in files:
+            target = os.path.join(dest, os.path.basename(path))
+            if not (os.path.exists(target)
+                    and os.path.getsize(target) == os.path.getsize(path)
+                    and os.path.getmtime(target) >= os.path.getmtime(path)):
+                shutil.copy2(path, target)
+            copied.append(target)
+        return copied
+
+    def merge_sample(self, sample):
+        # 把多lane样本的FASTQ.gz按字节拼接到merged/；单lane样本不做任何事
+        r1, r2 = self.lanes.get(sample, ([], []))
+        if len(r1) < 2:
+            return
+        merged = os.path.join(self.workdir, 'merged')
+        os.makedirs(merged, exist_ok=True)
+        outputs = [os.path.join(merged, f'{sample}_R{i}.fastq.gz') for i in (1, 2)]
+        key = self.cache.key('merge', {'lanes': len(r1)}, inputs=r1 + r2)
+        self.retention.produce('merge', sample, outputs, ['fastp'])
+        if self.cache.hit('merge', sample, key, released=sample not in self.restoring) is not None:
+            self.samples[sample] = outputs
+            return
+        with self.scheduler.reserve(1, self.rank.get(sample, 0)):
+            written = sum(concat_gzip(files, out) for files, out in zip((r1, r2), outputs))
+        self.metrics.add_sample('merge_lanes', sample, lanes=len(r1), write_bytes=written)
+        self.samples[sample] = outputs
+        self.cache.record('merge', sample, key, outputs)
+        self.logger.info(f"样本 '{sample}' 的{len(r1)}个lane已合并。")
+
+    def fastp_sample(self, sample):
+        # 对单个样本运行fastp（质量控制、接头去除和读取修复）
+        processed = os.path.join(self.workdir, 'processed_fastq')
+        os.makedirs(processed, exist_ok=True)
+        # 由调度器决定每个fastp的线程数
+        threads, _ = self.scheduler.plan('fastp', len(self.samples))
+        params = {
+            'q': self.q, 'min_len': self.min_len,
+            'F_remove': self.F_remove, 'R_remove': self.R_remove,
+            'version': tool_version('fastp --version'),
+        }
+        if self.fada:
+            params.update({'fada': self.fada, 'rada': self.rada})
+        outfq1 = os.path.join(processed, f'{sample}_R1.fastq.gz')
+        outfq2 = os.path.join(processed, f'{sample}_R2.fastq.gz')
+        reports = [os.path.join(processed, f'{sample}_fastp.{ext}') for ext in ('json', 'html')]
+
+        # 输入、参数和fastp版本都没变时直接复用上次的结果
+        # 多lane样本的输入是merged/中的中间文件，用原始lane文件计算指纹
+        r1, r2 = self.lanes[sample]
+        key = self.cache.key('fastp', params, inputs=r1 + r2)
+        self.retention.produce('fastp', sample, [outfq1, outfq2], self.fastp_consumers())
+        outputs = self.cache.hit('fastp', sample, key, released=sample not in self.restoring)
+        if outputs is not None:
+            self.samples[sample] = outputs
+            self.keys[sample] = key
+            self.retention.consume('merge', sample, 'fastp')
+            self.logger.info(f"样本 '{sample}' 的fastp结果未变化，跳过。")
+            return
+
+        # 检查输入文件是否存在（合并后的lane被删除时重新合并）
+        infq1, infq2 = self.require(sample, self.samples[sample])
+
+        cmd = f'fastp -i {infq1} -I {infq2} -o {outfq1} -O {outfq2} '
+        cmd += f'-q {self.q} -l {self.min_len} '
+        cmd += f'-f {self.F_remove} -F {self.R_remove} '
+        cmd += f'-w {threads} --json {reports[0]} '
+        cmd += f'--html {reports[1]} '
+        if self.fada:
+            cmd += f'--adapter_sequence {self.fada} --adapter_sequence_r2 {self.rada} '
+        cmd += '--correction --detect_adapter_for_pe'
+
+        with self.scheduler.reserve(threads, self.rank.get(sample, 0)):
+            self.execute_cmd(cmd, stage='fastp', sample=sample)
+        # fastp报告是最终产物，处理后的FASTQ是中间文件
+        self.keep_final(reports, 'processed_fastq')
+        self.samples[sample] = [outfq1, outfq2]
+        self.keys[sample] = key
+        self.cache.record('fastp', sample, key, [outfq1, outfq2])
+        self.retention.consume('merge', sample, 'fastp')
+        self.logger.info(f"样本 '{sample}' 处理完成。")
+
+    def fastp_consumers(self):
+        # 使用fastp输出的下游阶段（由子类决定）
+        raise NotImplementedError
+
+    def sample_qc(self):
+        # 每个样本的QC指标（决定样本是否进入Stacks分析），分片时随完成标记交给汇总步骤
+        return {}
+
+    def cohort_inputs(self, sample):
+        # 队列级阶段需要的该样本的文件；分片时必须位于共享的outdir中
+        raise NotImplementedError
+
+    def select_shard(self):
+        # 只保留本分片的样本；重新运行的分片先删除旧的完成标记
+        marker = os.path.join(self.shard_dir, SHARD_MARKER)
+        if os.path.exists(marker):
+            os.remove(marker)
+        mine = set(assign_shards(self.sizes, self.shard_count)[self.shard_index])
+        self.samples = {sample: files for sample, files in self.samples.items() if sample in mine}
+        self.lanes = {sample: files for sample, files in self.lanes.items() if sample in mine}
+        self.sizes = {sample: size for sample, size in self.sizes.items() if sample in mine}
+        self.order_samples()
+        self.logger.info(
+            f'分片 {self.shard_index}/{self.shard_count}: {len(self.samples)} 个样本，'
+            f'输入共 {sum(self.sizes.values())} 字节')
+
+    def write_shard_marker(self):
+        # 本分片的样本级阶段全部成功后写出完成标记：每个样本交给汇总步骤的文件、缓存键和QC指标，
+        # 以及这些样本的阶段缓存记录（汇总时并入outdir的阶段缓存清单）
+        qc = self.sample_qc()
+        marker = {
+            'shard': self.shard_index,
+            'count': self.shard_count,
+            'manifest': manifest_digest(self.ini),
+            'samples': {
+                sample: {
+                    'files': self.samples[sample], 'outputs': self.cohort_inputs(sample),
+                    'key': self.keys.get(sample), 'qc': qc.get(sample)}
+                for sample in sorted(self.samples)},
+            'cache': {
+                stage: {item: entry for item, entry in items.items() if item in self.samples}
+                for stage, items in self.cache.entries.items()},
+            'time': time.time(),
+        }
+        path = os.path.join(self.shard_dir, SHARD_MARKER)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(marker, f, indent=1)
+        os.replace(tmp, path)
+        self.logger.info(f'分片 {self.shard_index}/{self.shard_count} 完成，标记: {path}')
+
+    @instrumented
+    def gather_shards(self):
+        # 汇总步骤：检查所有分片的完成标记（分片数和样本清单与本次相同、覆盖清单中的每个样本、
+        # 交给队列级阶段的文件存在），再把各分片的样本结果和阶段缓存并入本次运行
+        digest = manifest_digest(self.ini)
+        problems = []
+        markers = []
+        for index in range(self.shard_count):
+            path = os.path.join(self.outdir, SHARD_DIR, str(index), SHARD_MARKER)
+            if not os.path.exists(path):
+                problems.append(f'分片 {index} 没有完成标记（{path}）')
+                continue
+            with open(path) as f:
+                marker = json.load(f)
+            if marker['count'] != self.shard_count or marker['manifest'] != digest:
+                problems.append(f'分片 {index} 的分片数或样本清单与本次运行不同')
+                continue
+            for sample, entry in marker['samples'].items():
+                missing = [f for f in entry['outputs'] if not os.path.exists(f)]
+                if missing:
+                    problems.append(f"样本 '{sample}' 的文件不存在: {', '.join(missing)}")
+            markers.append(marker)
+        done = {sample for marker in markers for sample in marker['samples']}
+        absent = sorted(set(self.samples) - done)
+        if absent and not problems:
+            problems.append(f"没有分片处理过的样本: {', '.join(absent)}")
+        if problems:
+            raise RuntimeError('分片汇总失败:\n' + '\n'.join(problems))
+        qc = self.sample_qc()
+        for marker in markers:
+            self.cache.merge(marker['cache'])
+            for sample, entry in marker['samples'].items():
+                self.samples[sample] = entry['files']
+                self.keys[sample] = entry['key']
+                if entry['qc'] is not None:
+                    qc[sample] = entry['qc']
+        self.logger.info(f'已汇总 {self.shard_count} 个分片的 {len(done)} 个样本。')
+
+    @instrumented
+    def pop_map_out(self, popmap=None):
+        # 创建或使用种群映射文件
+        if popmap is not None:
+            self.popmap = popmap
+        else:
+            names = list(self.analysis_samples().keys())
+            names.sort()
+            with open(os.path.join(self.outdir, "popmap.tsv"), "w") as f:
+                for name in names:
+                    f.write(f"{name}\t{name}\n")
+            self.popmap = os.path.join(self.outdir, "popmap.tsv")
+
+    def analysis_samples(self):
+        # 进入Stacks分析的样本：denovo去掉fastp QC不合格的样本，mapping去掉比对QC不合格的样本
+        return self.samples_for_analysis
+
+    @instrumented
+    def md_phylip(self):
+        # 去掉注释行，并按缺失率、不变位点和重复序列过滤比对后写出alignment_file
+        # 每个样本的缺失率和去留写入alignment_report.tsv；--phylip_source vcf时比对由过滤后的VCF基因型生成
+        # numpy只在这里用到，因此在运行时才导入
+        from migseq2.align import load_phylip, filter_alignment
+        from migseq2.vcf import vcf_to_genotypes, write_sample_report, filter_loci, genotypes_to_alignment
+        infile_path = os.path.join(self.stacks_out, 'populations.fixed.phylip')
+        outfile_path = self.alignment_file
+        vcf = os.path.join(self.stacks_out, 'populations.snps.vcf')
+        if not os.path.exists(vcf) and self.phylip_source == 'vcf':
+            raise FileNotFoundError(f"VCF文件 '{vcf}' 不存在。")
+        # 基因型矩阵和大比对的内存映射文件只在过滤期间使用：放在workdir下的临时目录中，结束后删除
+        with tempfile.TemporaryDirectory(dir=self.workdir, prefix='md_phylip-') as tmpdir:
+            if os.path.exists(vcf):
+                # VCF流式写成int8基因型矩阵，输出每个样本和每个位点的统计
+                genotypes = vcf_to_genotypes(vcf, os.path.join(tmpdir, 'genotypes'))
+                write_sample_report(genotypes, os.path.join(self.outdir, 'genotype_samples.tsv'))
+                keep = filter_loci(
+                    genotypes, os.path.join(self.outdir, 'genotype_loci.tsv'),
+                    self.min_maf, self.min_call_rate, self.max_obs_het)
+                self.logger.info(f'VCF位点过滤: 保留 {int(keep.sum())}/{genotypes.n_loci} 个位点')
+            if self.phylip_source == 'vcf':
+                names, matrix = genotypes_to_alignment(genotypes, keep, tmpdir)
+            else:
+                names, matrix = load_phylip(infile_path, tmpdir)
+            counts = filter_alignment(
+                names, matrix, outfile_path, os.path.join(self.outdir, 'alignment_report.tsv'),
+                self.max_sample_missing, self.max_site_missing, self.keep_invariant, self.dedupe)
+        self.logger.info(
+            f"比对过滤: 保留 {counts['kept_samples']}/{counts['samples']} 个样本、"
+            f"{counts['kept_sites']}/{counts['sites']} 个位点"
+            f"（缺失 {counts['missing_sites']}，不变 {counts['invariant_sites']}）")
+
+    def select_model(self):
+        # 只运行ModelFinder选择模型，结果以比对文件的全部内容和模型选项为键缓存：
+        # 比对不变时，只改变bootstrap或种子数的重新运行直接使用缓存的模型
+        base, _, rest = self.iq_model.partition('+')
+        if base not in MODEL_SELECTION:
+            return self.iq_model
+        phy_file = self.alignment_file
+        outpre = os.path.join(self.outdir, 'iq_model')
+        spec = '+'.join(filter(None, [MODEL_SELECTION[base], rest]))
+        params = {'model': spec, 'version': tool_version(f'{self.path_to_IQtree} --version')}
+        key = self.cache.key('iqtree_model', params, inputs=[phy_file], full=True)
+        if self.cache.hit('iqtree_model', 'all', key) is not None:
+            model = self.cache.meta('iqtree_model', 'all')['model']
+            self.logger.info(f'比对文件和模型选项未变化，使用已选出的模型 {model}。')
+            return model
+        self.execute_cmd(
+            f"{self.path_to_IQtree} -s {phy_file} -m {spec} -nt {self.t} -pre {outpre}",
+            stage='iqtree_model')
+        model, _ = read_iqtree_report(f'{outpre}.iqtree')
+        if model is None:
+            raise RuntimeError(f"ModelFinder的报告'{outpre}.iqtree'中没有选出的模型。")
+        self.cache.record('iqtree_model', 'all', key, [f'{outpre}.iqtree'], meta={'model': model})
+        self.logger.info(f'ModelFinder选出的模型: {model}')
+        return model
+
+    @instrumented
+    def iqtree(self):
+        # 运行IQ-TREE进行系统发育分析；线程数固定为-t（不用-nt AUTO探测线程数）
+        phy_file = self.alignment_file
+        outpre = os.path.join(self.outdir, 'iq')
+        model = self.select_model()
+        opts = f'-m {model}'
+        if self.bootstrap:
+            opts += f' -bb {self.bootstrap}'
+        if self.alrt:
+            opts += f' --alrt {self.alrt}'
+        params = {'opts': opts, 'seeds': self.iq_seeds, 'version': tool_version(f'{self.path_to_IQtree} --version')}
+        key = self.cache.key('iqtree', params, inputs=[phy_file], full=True)
+        if self.cache.hit('iqtree', 'all', key) is not None:
+            self.logger.info('比对文件和参数未变化，跳过IQ-TREE。')
+            return
+        if self.iq_seeds == 1:
+            self.execute_cmd(
+                f"{self.path_to_IQtree} -s {phy_file} {opts} -nt {self.t} -pre {outpre}", stage='iqtree')
+        else:
+            self.iqtree_seeds(phy_file, opts, outpre)
+        self.cache.record('iqtree', 'all', key, [f'{outpre}.treefile'])
+
+    def iqtree_seeds(self, phy_file, opts, outpre):
+        # 种子1..iq_seeds的独立搜索在-t线程内并行（每个运行固定分到-t/并行数个线程），
+        # 对数似然最高的运行的输出复制为outpre.*，各种子的结果写入iq_seeds.tsv
+        workers = min(self.iq_seeds, self.t)
+        threads = max(1, self.t // workers)
+        seeddir = os.path.join(self.outdir, 'iq_seeds')
+        os.makedirs(seeddir, exist_ok=True)
+
+        def run_seed(seed):
+            prefix = os.path.join(seeddir, f'seed{seed}')
+            self.execute_cmd(
+                f"{self.path_to_IQtree} -s {phy_file} {opts} -seed {seed} -nt {threads} -pre {prefix}",
+                stage='iqtree', sample=f'seed{seed}')
+            _, loglik = read_iqtree_report(f'{prefix}.iqtree')
+            if loglik is None:
+                raise RuntimeError(f"IQ-TREE的报告'{prefix}.iqtree'中没有树的对数似然。")
+            return loglik
+
+        seeds = list(range(1, self.iq_seeds + 1))
+        self.logger.info(f'IQ-TREE: {len(seeds)} 个种子，同时运行 {workers} 个，每个 {threads} 线程')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            logliks = dict(zip(seeds, executor.map(run_seed, seeds)))
+        best = max(seeds, key=lambda seed: (logliks[seed], -seed))
+        with open(os.path.join(self.outdir, IQ_SEEDS), 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['seed', 'log_likelihood', 'selected'])
+            for seed in seeds:
+                writer.writerow([seed, logliks[seed], int(seed == best)])
+        prefix = f'seed{best}.'
+        for name in os.listdir(seeddir):
+            if name.startswith(prefix):
+                shutil.copyfile(os.path.join(seeddir, name), f'{outpre}.{name[len(prefix):]}')
+        self.logger.info(f'对数似然最高的种子: {best}（{logliks[best]}）')
+
+    def record_history(self, status):
+        # 把本次运行的阶段和样本指标追加到运行历史；写入失败只记录警告
+        if self.history is None:
+            return
+        import sqlite3
+        from migseq2.history import record_run, run_params
+        peak = self.disk_monitor.sample()
+        mode = 'shard' if self.shard_index is not None else 'gather' if self.gather else 'full'
+        try:
+            run_id = record_run(
+                self.history, self.pipeline, self.project, run_params(self.run_params), self.metrics, self.t,
+                mode, status, self.scratch is not None, self.cache.hits, peak, self.outdir)
+        except (OSError, sqlite3.Error) as e:
+            self.logger.warning(f"无法写入运行历史 '{self.history}': {e}")
+            return
+        self.logger.info(f"运行历史 '{self.history}': 第 {run_id} 次运行（项目 {self.project}）")
+
+    def clean_scratch(self):
+        # 成功结束后删除scratch中剩余的中间文件；失败时保留以便续跑
+        if self.scratch is None:
+            return
+        self.retention.release_all()
+        shutil.rmtree(self.workdir, ignore_errors=True)
@@ -0,0 +1,825 @@
+# Migseq2 denovo流程：fastp -> 深度上限（可选） -> FASTA转换/重命名 -> Stacks denovo_map.pl -> IQ-TREE
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from migseq2.core import (
+    Pipeline, history_path, instrumented, parse_tool_curves, run_local_shards, timed_call,
+    tool_version)
+from migseq2.fastx import fastq_to_fasta, fastq_pairs, write_fastq_pairs
+
+
+NORM_K = 20  # 数字归一化使用的k-mer长度（2比特编码后放进uint64，不超过32）
+SKETCH_WIDTH = 1 << 22  # count-min sketch每行的计数器数（2的幂）
+SKETCH_DEPTH = 4  # count-min sketch的行数
+NORM_CHUNK = 1024  # 一次编码和哈希的读段对数
+SKETCH_HASH = 'multiply-shift'  # 写入深度上限的缓存键：哈希方式改变时归一化结果不同
+# 各行的乘法哈希系数（奇数常数）；结果与进程的哈希随机化无关
+SKETCH_SEEDS = (
+    0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+    0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9)
+
+
+def kmer_slots(seqs, k, width, depth):
+    # 一批读段的规范k-mer（正反链编码中较小的一个）在sketch各行中的位置，全部用NumPy向量化计算
+    # 读段以N连接成一个缓冲区，跨越读段边界或含非ACGT碱基的k-mer被去掉
+    # 返回 (slots[depth, n_kmer], 每个读段的k-mer在slots中的起止位置bounds[n_reads + 1])
+    import numpy as np
+    code = np.full(256, 4, dtype=np.uint8)
+    for i, base in enumerate(b'ACGT'):
+        code[base] = code[base + 32] = i
+    buf = code[np.frombuffer(b'N'.join(seqs), dtype=np.uint8)]
+    n = len(buf) - k + 1
+    if n <= 0:
+        return np.zeros((depth, 0), dtype=np.int64), np.zeros(len(seqs) + 1, dtype=np.int64)
+    bad = np.concatenate(([0], np.cumsum(buf == 4, dtype=np.int32)))
+    valid = np.flatnonzero(bad[k:] - bad[:-k] == 0)
+    # 长度为1、2、4、8...的窗口编码逐级倍增得到，再按k的二进制拼成长度k：只需O(log k)次数组运算
+    # fwd为正链编码（首碱基在高位），rev为反向互补链编码（首碱基的互补在低位）；16-mer以内用uint32
+    bases = buf.astype(np.uint32) & np.uint32(3)
+    fwd = {1: bases}
+    rev = {1: np.uint32(3) - bases}
+    size = 1
+    while 2 * size <= k:
+        if size == 16:
+            fwd[16], rev[16] = fwd[16].astype(np.uint64), rev[16].astype(np.uint64)
+        shift = fwd[size].dtype.type(2 * size)
+        fwd[2 * size] = (fwd[size][:-size] << shift) | fwd[size][size:]
+        rev[2 * size] = rev[size][:-size] | (rev[size][size:] << shift)
+        size *= 2
+    forward = reverse = None
+    offset = 0
+    for size in sorted(fwd, reverse=True):
+        if k - offset < size:
+            continue
+        f = fwd[size][offset:offset + n].astype(np.uint64)
+        r = rev[size][offset:offset + n].astype(np.uint64)
+        if forward is None:
+            forward, reverse = f, r
+        else:
+            forward = (forward << np.uint64(2 * size)) | f
+            reverse = reverse | (r << np.uint64(2 * offset))
+        offset += size
+    canonical = np.minimum(forward[valid], reverse[valid])
+    # 乘法哈希取高位：每行一个奇数系数，位置 = (code * seed) >> (64 - log2(width))
+    seeds = np.array(SKETCH_SEEDS[:depth], dtype=np.uint64)[:, None]
+    slots = ((canonical * seeds) >> np.uint64(64 - (width.bit_length() - 1))).view(np.int64)
+    starts = np.cumsum([0] + [len(seq) + 1 for seq in seqs])
+    return slots, np.searchsorted(valid, starts)
+
+
+def normalize_pairs(pairs, target, k=NORM_K, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    # 数字归一化（diginorm）：任一条读段的k-mer中位覆盖度低于target时保留该读段对，
+    # 并把它的k-mer计入count-min sketch（每个计数器1字节，饱和于255）；覆盖度已经足够的读段对被丢弃
+    # 编码和哈希按NORM_CHUNK对成批计算。计数只增不减，按批开始时的sketch中位覆盖度已经足够的读段对
+    # 之后也一定被丢弃，先整批向量化地排除；其余候选仍按输入顺序逐对判断，结果与逐对处理相同
+    # 中位数低于target等价于低于target的k-mer超过半数（排序后第len//2个低于target）
+    import numpy as np
+    tables = np.zeros((depth, width), dtype=np.uint8)
+    rows = np.arange(depth)[:, None]
+    pairs = iter(pairs)
+    while True:
+        chunk = list(itertools.islice(pairs, NORM_CHUNK))
+        if not chunk:
+            return
+        seqs = [rec.split(b'\n', 2)[1] for pair in chunk for rec in pair]
+        slots, bounds = kmer_slots(seqs, k, width, depth)
+        low = np.concatenate(([0], np.cumsum(tables[rows, slots].min(axis=0) < target)))
+        lengths = np.diff(bounds)
+        under = (lengths > 0) & (low[bounds[1:]] - low[bounds[:-1]] > lengths // 2)
+        empty = lengths[0::2] + lengths[1::2] == 0
+        for i in np.flatnonzero(under[0::2] | under[1::2] | empty):
+            rec1, rec2 = chunk[i]
+            lo, mid, hi = bounds[2 * i], bounds[2 * i + 1], bounds[2 * i + 2]
+            if lo == hi:
+                yield rec1, rec2
+                continue
+            index = (rows, slots[:, lo:hi])
+            current = tables[index]
+            below = current.min(axis=0) < target
+            if (mid > lo and below[:mid - lo].sum() > (mid - lo) // 2
+                    or hi > mid and below[mid - lo:].sum() > (hi - mid) // 2):
+                tables[index] = current + (current < 255)
+                yield rec1, rec2
+
+
+def reservoir_sample(items, size, rng):
+    # Algorithm L：单遍扫描、O(size)内存的无放回等概率抽样，跳过的元素不消耗随机数
+    # 返回 (按原始顺序排列的样本, 元素总数)
+    items = enumerate(items)
+    sample = list(itertools.islice(items, size))
+    total = len(sample)
+    if total == size:
+        w = math.exp(math.log(1.0 - rng.random()) / size)
+        skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - w))
+        for i, item in items:
+            total = i + 1
+            if skip:
+                skip -= 1
+                continue
+            sample[rng.randrange(size)] = (i, item)
+            w *= math.exp(math.log(1.0 - rng.random()) / size)
+            skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - w))
+    sample.sort(key=lambda entry: entry[0])
+    return [item for _, item in sample], total
+
+
+def subsample_pairs(sample, fastq1, fastq2, out1, out2, max_pairs=0, target=0,
+                    k=NORM_K, seed=1):
+    # 单遍限制一个样本的读段对数：可选先做k-mer数字归一化，再对剩余读段对做蓄水池抽样
+    # 随机数以(seed, 样本名)为种子，结果可重复；只做抽样且没有超过上限时不写出文件
+    # 返回 (输入对数, 保留对数, 是否写出了out1/out2)
+    total = 0
+
+    def counted():
+        nonlocal total
+        for pair in fastq_pairs(fastq1, fastq2):
+            total += 1
+            yield pair
+
+    pairs = counted()
+    if target:
+        pairs = normalize_pairs(pairs, target, k)
+    if max_pairs:
+        pairs, _ = reservoir_sample(pairs, max_pairs, random.Random(f'{seed}:{sample}'))
+        if not target and total <= max_pairs:
+            return total, total, False
+    kept = write_fastq_pairs(pairs, out1, out2)
+    return total, kept, True
+
+
+FASTP_QC = 'fastp_qc.tsv'  # outdir中的fastp QC汇总表
+# fastp_qc.tsv的列（读段数为R1和R2合计）
+FASTP_QC_COLUMNS = (
+    'reads_before', 'reads_after', 'pass_frac', 'q30_before', 'q30_after',
+    'duplication', 'insert_size', 'low_quality', 'too_short', 'adapter_trimmed')
+
+
+def fastp_qc(report):
+    # 从一个样本的fastp JSON报告中取出QC指标
+    with open(report) as f:
+        data = json.load(f)
+    before = data['summary']['before_filtering']
+    after = data['summary']['after_filtering']
+    filtering = data.get('filtering_result', {})
+    return {
+        'reads_before': before['total_reads'],
+        'reads_after': after['total_reads'],
+        'pass_frac': after['total_reads'] / before['total_reads'] if before['total_reads'] else 0.0,
+        'q30_before': before.get('q30_rate', 0.0),
+        'q30_after': after.get('q30_rate', 0.0),
+        'duplication': data.get('duplication', {}).get('rate', 0.0),
+        'insert_size': data.get('insert_size', {}).get('peak', 0),
+        'low_quality': filtering.get('low_quality_reads', 0),
+        'too_short': filtering.get('too_short_reads', 0),
+        'adapter_trimmed': data.get('adapter_cutting', {}).get('adapter_trimmed_reads', 0),
+    }
+
+
+SWEEP_PARAMS = {'m': int, 'M': int, 'N': int, 'r': float}  # --sweep可以扫描的参数
+SWEEP_SUMMARY = 'sweep_summary.tsv'  # outdir中的参数扫描结果表
+# populations.log中的汇总行
+POPULATIONS_KEPT = re.compile(
+    r'Kept (\d+) loci, composed of (\d+) sites; (\d+) of those sites were filtered, '
+    r'(\d+) variant sites remained')
+
+
+def parse_sweep(specs):
+    # 解析 --sweep 参数，格式为 name=v1,v2,...（name为m、M、N或r）
+    grid = {}
+    for spec in specs or []:
+        name, _, values = spec.partition('=')
+        name = name.strip()
+        if name not in SWEEP_PARAMS:
+            raise ValueError(f"--sweep 不支持参数 '{name}'（可用: {', '.join(SWEEP_PARAMS)}）")
+        grid[name] = [SWEEP_PARAMS[name](v) for v in values.split(',') if v.strip()]
+    return grid
+
+
+def populations_stats(path):
+    # populations输出目录中保留的位点数、SNP数（populations.log）和多态位点数（VCF中不同的位点）
+    with open(os.path.join(path, 'populations.log')) as f:
+        kept = POPULATIONS_KEPT.search(f.read())
+    loci = set()
+    with open(os.path.join(path, 'populations.snps.vcf')) as f:
+        for line in f:
+            if not line.startswith('#'):
+                loci.add(line.split('\t', 3)[2].split(':')[0])
+    return {
+        'loci': int(kept.group(1)) if kept else 0,
+        'snps': int(kept.group(4)) if kept else 0,
+        'polymorphic_loci': len(loci),
+    }
+
+class SampleCodeClass(Pipeline):
+    pipeline = 'denovo'  # 运行历史中的流程名
+
+    def __init__(
+            self, indir, q,
+            F_remove, R_remove, t, min_len, outdir,
+            m, M, N, r, pop_opts, keep_fa=False, tool_curves=None,
+            force=False, profile=False, manifest=None, scratch=None, cleanup=False,
+            max_pairs=0, normalize=0, norm_k=NORM_K, subsample_seed=1, incremental=False,
+            sweep=None, max_sample_missing=1.0, max_site_missing=1.0, keep_invariant=False,
+            dedupe=False, phylip_source='fixed', min_maf=0.0, min_call_rate=0.0, max_obs_het=1.0,
+            min_qc_reads=0, min_q30_rate=0.0, max_dup_rate=1.0, shard_index=None, shard_count=0,
+            gather=False, iq_model='MFP+ASC', bootstrap=1000, alrt=1000, iq_seeds=1, history=None,
+            project=None, run_params=None):
+        # 初始化类的属性
+        if not os.path.exists(indir):
+            raise FileNotFoundError(f"输入目录 '{indir}' 不存在。请检查路径。")
+        super().__init__(
+            indir, outdir, q, F_remove, R_remove, t, min_len, r, pop_opts,
+            tool_curves=tool_curves, force=force, profile=profile, manifest=manifest,
+            scratch=scratch, cleanup=cleanup, max_sample_missing=max_sample_missing,
+            max_site_missing=max_site_missing, keep_invariant=keep_invariant, dedupe=dedupe,
+            phylip_source=phylip_source, min_maf=min_maf, min_call_rate=min_call_rate,
+            max_obs_het=max_obs_het, shard_index=shard_index, shard_count=shard_count,
+            gather=gather, iq_model=iq_model, bootstrap=bootstrap, alrt=alrt, iq_seeds=iq_seeds,
+            history=history, project=project, run_params=run_params)
+        self.path_to_bin = "/usr/local/bin/"  # 二进制文件路径
+        self.m = m  # 最小覆盖深度
+        self.M = M  # 最大距离
+        self.N = N  # 次要读取对齐的最大距离
+        self.incremental = incremental  # 在pl/中已有的Stacks目录上只添加新样本
+        self.sweep_grid = sweep or {}  # 参数扫描：{参数名: 取值列表}
+        self.keep_fa = keep_fa  # 是否保留未压缩的fa/中间文件
+        self.stacks_out = os.path.join(outdir, 'pl')  # denovo_map.pl的输出目录
+        self.alignment_file = os.path.join(outdir, 'pl', 'pop.phy')  # 交给IQ-TREE的比对
+        # 重命名的FASTA；分片运行时它们是交给汇总步骤的产物，即使指定scratch也写到outdir中
+        self.renamed_dir = os.path.join(outdir if shard_count else self.workdir, 'renamed')
+        # 可选的深度上限：每个样本最多max_pairs对读段，和/或k-mer覆盖度归一化到normalize
+        self.max_pairs = max_pairs
+        self.normalize = normalize
+        if normalize and not 1 <= norm_k <= 32:
+            raise ValueError(f'--norm_k 必须在1到32之间（k-mer编码为64位整数），当前为 {norm_k}。')
+        self.norm_k = norm_k
+        self.subsample_seed = subsample_seed
+        self.subsample_stats = {}  # 每个样本输入和保留的读段对数
+        # fastp QC的排除阈值：过滤后读段数（R1+R2）、过滤后Q30比例的下限和重复率的上限
+        self.min_qc_reads = min_qc_reads
+        self.min_q30_rate = min_q30_rate
+        self.max_dup_rate = max_dup_rate
+        self.fastp_qc = {}  # 每个样本的fastp QC指标
+
+    def fastp_consumers(self):
+        return ['subsample', 'fasta'] if self.max_pairs or self.normalize else ['fasta']
+
+    def sample_qc(self):
+        return self.fastp_qc
+
+    def cohort_inputs(self, sample):
+        return list(self.samples[sample])
+
+    def qc_sample(self, sample):
+        # 在共享的进程池中解析单个样本的fastp JSON；以报告内容为键缓存，fastp未重新运行时不再解析
+        report = os.path.join(self.outdir, 'processed_fastq', f'{sample}_fastp.json')
+        key = self.cache.key('fastp_qc', {}, inputs=[report])
+        if self.cache.hit('fastp_qc', sample, key) is not None:
+            self.fastp_qc[sample] = dict(self.cache.meta('fastp_qc', sample))
+            return
+        with self.scheduler.reserve(1, self.rank.get(sample, 0)):
+            qc, wall, cpu = self.pool.submit(timed_call, fastp_qc, report).result()
+        self.metrics.add_sample(
+            'exclude_low_yield_samples', sample, wall=wall, cpu=cpu,
+            read_bytes=os.path.getsize(report))
+        self.fastp_qc[sample] = dict(qc)
+        self.cache.record('fastp_qc', sample, key, [], meta=qc)
+
+    @instrumented
+    def exclude_low_yield_samples(self):
+        # 写出fastp_qc.tsv，并去掉低于阈值的样本（空白对照、失败的文库等），它们不进入popmap和Stacks
+        # sample_stages中没有解析的报告在这里并行解析
+        samples = list(self.samples.keys())
+        missing = [sample for sample in samples if sample not in self.fastp_qc]
+        if missing:
+            self.run_samples([self.qc_sample], samples=missing)
+        excluded = []
+        self.samples_for_analysis = {}
+        for sample in samples:
+            qc = self.fastp_qc[sample]
+            qc['excluded'] = (
+                qc['reads_after'] < self.min_qc_reads
+                or qc['q30_after'] < self.min_q30_rate
+                or qc['duplication'] > self.max_dup_rate)
+            if qc['excluded']:
+                excluded.append(sample)
+            else:
+                self.samples_for_analysis[sample] = self.samples[sample]
+        columns = FASTP_QC_COLUMNS + ('excluded',)
+        path = os.path.join(self.outdir, FASTP_QC)
+        with open(path, 'w') as f:
+            f.write('sample\t' + '\t'.join(columns) + '\n')
+            for sample in samples:
+                qc = self.fastp_qc[sample]
+                row = [f'{qc[c]:.4f}' if isinstance(qc[c], float) else str(qc[c]) for c in columns]
+                f.write(sample + '\t' + '\t'.join(row) + '\n')
+        if excluded:
+            self.logger.info(f"fastp QC未达到阈值，排除{len(excluded)}个样本: {', '.join(sorted(excluded))}")
+        if not self.samples_for_analysis:
+            raise RuntimeError(f'所有样本都未达到fastp QC阈值，详见 {path}')
+
+    def subsample_sample(self, sample):
+        # 可选的深度上限阶段（fastp之后、FASTA转换之前），限制ustacks/cstacks的时间和内存
+        if not (self.max_pairs or self.normalize):
+            return
+        subsampled = os.path.join(self.workdir, 'subsampled')
+        os.makedirs(subsampled, exist_ok=True)
+        outputs = [os.path.join(subsampled, f'{sample}_R{i}.fastq.gz') for i in (1, 2)]
+        params = {
+            'max_pairs': self.max_pairs, 'normalize': self.normalize,
+            'k': self.norm_k, 'seed': self.subsample_seed,
+        }
+        if self.normalize:
+            params['sketch'] = SKETCH_HASH
+        key = self.cache.key('subsample', params, upstream=[self.keys.get(sample)])
+        self.retention.produce('subsample', sample, outputs, ['fasta'])
+        cached = self.cache.hit('subsample', sample, key, released=sample not in self.restoring)
+        if cached is not None:
+            self.samples[sample] = cached
+            self.keys[sample] = key
+            self.subsample_stats[sample] = self.cache.meta('subsample', sample)
+            self.retention.consume('fastp', sample, 'subsample')
+            return
+        fq1, fq2 = self.require(sample, self.samples[sample])
+        with self.scheduler.reserve(1, self.rank.get(sample, 0)):
+            (total, kept, written), wall, cpu = self.pool.submit(
+                timed_call, subsample_pairs, sample, fq1, fq2, *outputs,
+                self.max_pairs, self.normalize, self.norm_k, self.subsample_seed).result()
+        if not written:
+            # 没有超过上限，直接使用fastp的输出
+            outputs = [fq1, fq2]
+        stats = {'input_pairs': total, 'kept_pairs': kept}
+        self.subsample_stats[sample] = stats
+        self.metrics.add_sample('subsample', sample, wall=wall, cpu=cpu, reads=2 * total)
+        self.samples[sample] = outputs
+        self.keys[sample] = key
+        self.cache.record('subsample', sample, key, outputs, meta=stats)
+        self.retention.consume('fastp', sample, 'subsample')
+        self.logger.debug(f"样本 '{sample}': 保留 {kept}/{total} 对读段")
+
+    def write_subsample_report(self):
+        # subsample_report.tsv：每个样本输入和保留的读段对数
+        if not self.subsample_stats:
+            return
+        path = os.path.join(self.outdir, 'subsample_report.tsv')
+        with open(path, 'w') as f:
+            f.write('sample\tinput_pairs\tkept_pairs\tkept_frac\n')
+            for sample in sorted(self.subsample_stats):
+                stats = self.subsample_stats[sample]
+                frac = stats['kept_pairs'] / stats['input_pairs'] if stats['input_pairs'] else 0.0
+                f.write(f"{sample}\t{stats['input_pairs']}\t{stats['kept_pairs']}\t{frac:.4f}\n")
+        total = sum(stats['input_pairs'] for stats in self.subsample_stats.values())
+        kept = sum(stats['kept_pairs'] for stats in self.subsample_stats.values())
+        self.logger.info(f"深度上限: 共保留 {kept}/{total} 对读段，详见 {path}")
+
+    def fasta_sample(self, sample):
+        # 将单个样本的FASTQ.gz流式转换为重命名后的FASTA.gz（renamed/）
+        # 只有指定--keep_fa时才额外写出未压缩的fa/*.fasta
+        renamed = self.renamed_dir
+        os.makedirs(renamed, exist_ok=True)
+        fa = None
+        if self.keep_fa:
+            fa = os.path.join(self.workdir, 'fa')
+            os.makedirs(fa, exist_ok=True)
+        key = self.cache.key(
+            'fasta', {'keep_fa': self.keep_fa}, upstream=[self.keys.get(sample)])
+        renamed_files = [os.path.join(renamed, f'{sample}.{i}.fasta.gz') for i in (1, 2)]
+        if not self.shard_count:
+            self.retention.produce('fasta', sample, renamed_files, ['pl_stacks'])
+        outputs = self.cache.hit('fasta', sample, key, released=sample not in self.restoring)
+        if outputs is not None:
+            self.samples[sample] = outputs
+            self.keys[sample] = key
+            self.retention.consume('fastp', sample, 'fasta')
+            self.retention.consume('subsample', sample, 'fasta')
+            return
+        self.samples[sample] = self.require(sample, self.samples[sample])
+        # R1和R2各占一个进程池任务（绕开GIL），每个任务再用若干线程做BGZF压缩
+        threads, _ = self.scheduler.plan('bgzf', 2 * len(self.samples))
+        jobs = []
+        for i, fastq_file in enumerate(self.samples[sample]):
+            renamed_file = os.path.join(renamed, f'{sample}.{i+1}.fasta.gz')
+            fasta_file = None
+            if fa is not None:
+                fasta_file = os.path.join(fa, f'{sample}.{i+1}.fasta')
+            jobs.append((sample, i + 1, fastq_file, renamed_file, fasta_file, threads))
+        with self.scheduler.reserve(len(jobs) * threads, self.rank.get(sample, 0)):
+            futures = [self.pool.submit(timed_call, fastq_to_fasta, *job) for job in jobs]
+            results = [future.result() for future in futures]
+        renamed_files = []
+        for (_, read_no, fastq_file, renamed_file, _, _), (n, wall, cpu) in zip(jobs, results):
+            self.logger.debug(f"样本 '{sample}' R{read_no}: {n} 条序列")
+            self.metrics.add_sample(
+                'fasta', sample, wall=wall, cpu=cpu, reads=n,
+                read_bytes=os.path.getsize(fastq_file),
+                write_bytes=os.path.getsize(renamed_file))
+            renamed_files.append(renamed_file)
+        if fa is not None:
+            self.keep_final([job[4] for job in jobs], 'fa')
+        self.samples[sample] = renamed_files
+        self.keys[sample] = key
+        self.cache.record('fasta', sample, key, renamed_files)
+        self.retention.consume('fastp', sample, 'fasta')
+        self.retention.consume('subsample', sample, 'fasta')
+
+    @instrumented
+    def sample_stages(self):
+        # 样本级阶段流水线：每个样本合并lane、完成fastp（及其QC解析）和深度上限后立即转换，不等待其他样本
+        self.sample_steps = [
+            self.merge_sample, self.fastp_sample, self.qc_sample, self.subsample_sample,
+            self.fasta_sample]
+        self.run_samples(self.sample_steps)
+        self.write_subsample_report()
+        self.inputfasta = [file for sublist in self.samples.values() for file in sublist]
+
+    @instrumented
+    def pl_stacks(self, from_fa=None):
+        # 运行Stacks的denovo_map.pl脚本；指定--incremental时在已有目录上只处理新样本
+        renamed = self.renamed_dir
+        pl = os.path.join(self.outdir, 'pl')
+        os.makedirs(pl, exist_ok=True)
+        if from_fa is not None:
+            renamed = from_fa
+            inputs = sorted(os.path.join(renamed, f) for f in os.listdir(renamed))
+            upstream = []
+        else:
+            inputs = []
+            upstream = [self.keys.get(sample) for sample in sorted(self.analysis_samples())]
+        stacks = self.stacks_params()
+        params = {
+            'r': self.r, 'pop_opts': self.pop_opts, 'stacks': stacks,
+            'version': tool_version('denovo_map.pl --version'),
+        }
+        key = self.cache.key(
+            'pl_stacks', params, inputs=inputs + [self.popmap], upstream=upstream)
+        if self.cache.hit('pl_stacks', 'all', key) is not None:
+            self.logger.info('Stacks的输入和参数未变化，跳过denovo_map.pl。')
+            self.release_renamed()
+            return
+        catalog = None
+        if from_fa is None and self.incremental:
+            catalog = self.extend_catalog(pl)
+        if catalog is None:
+            if from_fa is None:
+                # 重命名的FASTA已被删除时先重新生成
+                self.require_samples(sorted(self.analysis_samples()))
+            self.execute_cmd(self.denovo_map_cmd(pl, renamed, stacks, self.r, self.t), stage='pl_stacks')
+            if from_fa is None:
+                # denovo_map.pl按popmap中的顺序从1开始编号样本
+                with open(self.popmap) as f:
+                    order = [line.split()[0] for line in f if line.strip() and not line.startswith('#')]
+                catalog = {
+                    'params': stacks,
+                    'samples': {
+                        sample: {'id': i, 'key': self.keys.get(sample)}
+                        for i, sample in enumerate(order, 1)},
+                    'gstacks': sorted(self.analysis_samples()),
+                }
+        self.cache.record(
+            'pl_stacks', 'all', key, [os.path.join(pl, 'populations.fixed.phylip')],
+            meta=None if catalog is None else {'catalog': catalog})
+        self.release_renamed()
+        # ustacks选项说明
+        #-f  输入文件路径
+        #-i  此样本的唯一整数ID
+        #-o  写入结果的输出路径
+        #-M  允许的堆栈之间的最大距离（以核苷酸为单位）（默认2）
+        #-m  创建堆栈所需的最小覆盖深度（默认3）
+        #-N  允许将次要读取对齐到主要堆栈的最大距离（默认：M + 2）
+        #-p  启用并行执行，使用num_threads线程
+        #-t  输入文件类型。支持的类型：fasta, fastq, gzfasta, 或 gzfastq（默认：猜测）
+        #--name  样本的名称（默认：输入文件名减去后缀）
+        #-R  保留未使用的读取
+        #-H  禁用从次要读取调用单倍型
+
+    def stacks_params(self, **grid):
+        # 决定ustacks/cstacks结果的参数（grid覆盖命令行的值）；与建立目录时不同则不能增量添加
+        params = {'m': self.m, 'M': self.M, 'N': self.N}
+        params.update(grid)
+        params['version'] = tool_version('ustacks --version')
+        return params
+
+    def denovo_map_cmd(self, pl, renamed, stacks, r, threads):
+        return f'denovo_map.pl -M {stacks["M"]} -T {threads} -o {pl} --popmap {self.popmap} --samples {renamed} --paired -N {stacks["N"]} -X "ustacks:-m {stacks["m"]} --force-diff-len" -X "populations: {self.populations_options(r, threads)}"'
+
+    def populations_options(self, r=None, threads=None):
+        r = self.r if r is None else r
+        return f'-M {self.popmap} -R {r} --max-obs-het 0.99 --write-single-snp --min-maf 0.01 --vcf --structure --plink --treemix --phylip -t {threads or self.t} {self.pop_opts}'
+
+    @instrumented
+    def sweep(self):
+        # 参数扫描：m/M/N的每种组合运行一次denovo_map.pl，各组合共享同一份renamed/输入并在CPU预算内并发运行；
+        # 同一组合的第一个r沿用denovo_map.pl的populations输出，其余的r只重新运行populations。结果汇总到sweep_summary.tsv，不运行IQ-TREE
+        names = ['m', 'M', 'N']
+        values = [self.sweep_grid.get(name, [getattr(self, name)]) for name in names]
+        configs = [dict(zip(names, combo)) for combo in itertools.product(*values)]
+        rs = self.sweep_grid.get('r', [self.r])
+        self.logger.info(f'参数扫描: {len(configs)} 种m/M/N组合 x {len(rs)} 个r值')
+        upstream = [self.keys.get(sample) for sample in sorted(self.analysis_samples())]
+        keys = [
+            self.cache.key('sweep', self.stacks_params(**config), inputs=[self.popmap], upstream=upstream)
+            for config in configs]
+        if any(self.cache.hit('sweep', self.sweep_name(config), key) is None
+               for config, key in zip(configs, keys)):
+            # 重命名的FASTA已被删除时先重新生成（所有组合共用）
+            self.require_samples(sorted(self.analysis_samples()))
+        threads, _ = self.scheduler.plan('denovo_map', len(configs))
+        rows = []
+        with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+            futures = [
+                executor.submit(self.sweep_config, config, key, rs, threads)
+                for config, key in zip(configs, keys)]
+            for future in futures:
+                rows.extend(future.result())
+        self.release_renamed()
+        path = os.path.join(self.outdir, SWEEP_SUMMARY)
+        with open(path, 'w') as f:
+            f.write('setting\tm\tM\tN\tr\tloci\tsnps\tpolymorphic_loci\n')
+            for row in rows:
+                f.write('\t'.join(str(row[col]) for col in (
+                    'setting', 'm', 'M', 'N', 'r', 'loci', 'snps', 'polymorphic_loci')) + '\n')
+        self.logger.info(f'参数扫描完成，结果见 {path}')
+
+    def sweep_name(self, config):
+        return f"m{config['m']}_M{config['M']}_N{config['N']}"
+
+    def sweep_config(self, config, key, rs, threads):
+        # 一种m/M/N组合：denovo_map.pl输出在sweep/{组合}/，每个r的populations输出在其下的r{r}/
+        name = self.sweep_name(config)
+        pl = os.path.join(self.outdir, 'sweep', name)
+        if self.cache.hit('sweep', name, key) is None:
+            os.makedirs(pl, exist_ok=True)
+            renamed = self.renamed_dir
+            with self.scheduler.reserve(threads):
+                self.execute_cmd(
+                    self.denovo_map_cmd(pl, renamed, config, rs[0], threads),
+                    stage='sweep', sample=name)
+            self.cache.record(
+                'sweep', name, key, [os.path.join(pl, 'catalog.fa.gz')],
+                meta={'r': rs[0], 'pop_opts': self.pop_opts})
+        # denovo_map.pl已经用这个r运行过populations：链接它的输出，不再重复运行
+        ran = self.cache.meta('sweep', name) or {}
+        rows = []
+        for r in rs:
+            outdir = os.path.join(pl, f'r{r:g}')
+            item = f'{name}/r{r:g}'
+            params = {
+                'r': r, 'pop_opts': self.pop_opts,
+                'version': tool_version('populations --version'),
+            }
+            pop_key = self.cache.key('sweep_populations', params, upstream=[key])
+            if self.cache.hit('sweep_populations', item, pop_key) is None:
+                os.makedirs(outdir, exist_ok=True)
+                if ran.get('r') == r and ran.get('pop_opts') == self.pop_opts:
+                    for f in os.listdir(pl):
+                        if f.startswith('populations.'):
+                            target = os.path.join(outdir, f)
+                            if os.path.exists(target):
+                                os.remove(target)
+                            os.link(os.path.join(pl, f), target)
+                else:
+                    with self.scheduler.reserve(threads):
+                        self.execute_cmd(
+                            f'populations -P {pl} -O {outdir} {self.populations_options(r, threads)}',
+                            stage='sweep_populations', sample=item.replace('/', '_'))
+                self.cache.record('sweep_populations', item, pop_key, [
+                    os.path.join(outdir, 'populations.log'),
+                    os.path.join(outdir, 'populations.snps.vcf')])
+            rows.append({'setting': item, **config, 'r': r, **populations_stats(outdir)})
+        return rows
+
+    def extend_catalog(self, pl):
+        # 增量模式：只对新样本运行ustacks，用cstacks -c把它们加入已有目录，
+        # 再对新样本运行sstacks/tsv2bam；gstacks需要所有样本的读段，样本集合变化时对全体重新运行
+        # 返回更新后的目录信息；不能增量添加时返回None（改为完整运行denovo_map.pl）
+        catalog = (self.cache.meta('pl_stacks', 'all') or {}).get('catalog')
+        stacks = self.stacks_params()
+        if catalog is None or not os.path.exists(os.path.join(pl, 'catalog.tags.tsv.gz')):
+            reason = '没有可以扩展的Stacks目录'
+        elif catalog['params'] != stacks:
+            reason = 'ustacks/cstacks的参数或版本已变化'
+        else:
+            changed = sorted(
+                sample for sample, entry in catalog['samples'].items()
+                if sample in self.analysis_samples() and entry['key'] != self.keys.get(sample))
+            reason = f"目录中样本的输入已变化: {', '.join(changed)}" if changed else None
+        if reason is not None:
+            self.logger.info(f'{reason}，完整运行denovo_map.pl。')
+            return None
+        new = [sample for sample in sorted(self.analysis_samples()) if sample not in catalog['samples']]
+        samples = dict(catalog['samples'])
+        next_id = max((entry['id'] for entry in samples.values()), default=0) + 1
+        for sample in new:
+            samples[sample] = {'id': next_id, 'key': self.keys.get(sample)}
+            next_id += 1
+        if new:
+            self.logger.info(f'增量模式: 向已有的Stacks目录添加 {len(new)} 个新样本。')
+            self.require_samples(new)
+            threads, _ = self.scheduler.plan('ustacks', len(new))
+            self.run_commands('ustacks', threads, {
+                sample: f'ustacks -f {self.samples[sample][0]} -i {samples[sample]["id"]} --name {sample} -o {pl} -M {stacks["M"]} -m {stacks["m"]} -N {stacks["N"]} -p {threads} --force-diff-len'
+                for sample in new})
+            cmd = f'cstacks -c {os.path.join(pl, "catalog")} -o {pl} -n {stacks["M"]} -p {self.t}'
+            cmd += ''.join(f' -s {os.path.join(pl, sample)}' for sample in new)
+            with self.scheduler.reserve(self.t):
+                self.execute_cmd(cmd, stage='cstacks')
+            # 目录中已有位点的编号不变，旧样本的sstacks/tsv2bam结果继续有效
+            threads, _ = self.scheduler.plan('sstacks', len(new))
+            self.run_commands('sstacks', threads, {
+                sample: f'sstacks -c {os.path.join(pl, "catalog")} -s {os.path.join(pl, sample)} -o {pl} -p {threads}'
+                f' && tsv2bam -P {pl} -s {sample} -R {os.path.dirname(self.samples[sample][1])} -t {threads}'
+                for sample in new})
+        else:
+            self.logger.info('增量模式: 没有新样本，只重新运行后续阶段。')
+        if new or catalog['gstacks'] != sorted(self.analysis_samples()):
+            with self.scheduler.reserve(self.t):
+                self.execute_cmd(f'gstacks -P {pl} -M {self.popmap} -t {self.t}', stage='gstacks')
+        with self.scheduler.reserve(self.t):
+            self.execute_cmd(f'populations -P {pl} {self.populations_options()}', stage='populations')
+        return {'params': stacks, 'samples': samples, 'gstacks': sorted(self.analysis_samples())}
+
+    def run_commands(self, stage, threads, commands):
+        # 每个样本一条外部命令，在调度器的CPU预算内并发运行
+        def run(sample, cmd):
+            with self.scheduler.reserve(threads, self.rank.get(sample, 0)):
+                self.execute_cmd(cmd, stage=stage, sample=sample)
+        if not commands:
+            return
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            futures = [executor.submit(run, sample, cmd) for sample, cmd in commands.items()]
+            for future in futures:
+                future.result()
+
+    def release_renamed(self):
+        # denovo_map.pl是重命名FASTA的最后一个消费者
+        for sample in self.samples:
+            self.retention.consume('fasta', sample, 'pl_stacks')
+
+    def run(self, popmap=None, from_fa=None):
+        try:
+            if from_fa is not None:
+                print('从FASTA文件开始')
+                if popmap is None:
+                    print('请输入popmap文件')
+                    sys.exit(1)
+                self.popmap = popmap
+                self.pl_stacks(from_fa=from_fa)
+                self.md_phylip()
+                self.iqtree()
+                self.clean_scratch()
+                return 0
+
+            if self.ini is None:
+                self.make_sample_ini()
+            self.load_ini()
+            if self.shard_index is not None:
+                # 分片运行：只对本分片的样本运行样本级阶段，写出完成标记后结束
+                self.select_shard()
+                self.sample_stages()
+                self.write_shard_marker()
+                self.clean_scratch()
+                return 0
+            if self.gather:
+                self.gather_shards()
+            else:
+                # 每个样本独立完成fastp（质量控制、接头去除和读取修复）和FASTA转换/重命名
+                self.sample_stages()
+            self.exclude_low_yield_samples()
+            self.pop_map_out()
+            if self.sweep_grid:
+                self.sweep()
+                self.clean_scratch()
+                return 0
+            self.pl_stacks()
+            self.md_phylip()
+            self.iqtree()
+            self.clean_scratch()
+        except Exception as e:
+            self.logger.error(f"运行分析流程时出错: {e}")
+            sys.exit(1)
+        finally:
+            self.metrics.storage = {
+                'workdir': self.workdir, 'freed_bytes': self.retention.freed_bytes}
+            self.metrics.write()
+            self.record_history('failed' if sys.exc_info()[0] else 'ok')
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Migseq2 de novo pipeline (fastp, Stacks denovo_map.pl, IQ-TREE)')
+    parser.add_argument('-i', '--indir', required=True, help='Input directory')
+    parser.add_argument('-o', '--outdir', required=True, help='Output directory')
+    parser.add_argument('-q', '--quality', type=int, default=20, help='Quality threshold')
+    parser.add_argument('-F', '--F_remove', type=int, default=0, help='Bases to remove from forward reads')
+    parser.add_argument('-R', '--R_remove', type=int, default=0, help='Bases to remove from reverse reads')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of threads')
+    parser.add_argument('-l', '--min_len', type=int, default=30, help='Minimum length threshold')
+    parser.add_argument('-m', '--min_cov', type=int, default=3, help='Minimum coverage')
+    parser.add_argument('-M', '--max_dist', type=int, default=2, help='Maximum distance')
+    parser.add_argument('-N', '--max_dist_secondary', type=int, default=4, help='Maximum distance for secondary reads')
+    parser.add_argument('--r', type=float, default=0.8, help='r value')
+    parser.add_argument('--pop_opts', default='', help='Population options')
+    parser.add_argument('--from_fa', help='Start from fasta file (optional)')
+    parser.add_argument('--popmap', help='Population map file (optional)')
+    parser.add_argument('--tool_curve', action='append', default=[], help='Tool efficiency curve as tool=p[:max_threads], e.g. fastp=0.8:4 (repeatable)')
+    parser.add_argument('--force', action='store_true', help='Ignore the stage cache in outdir and rerun every stage')
+    parser.add_argument('--profile', action='store_true', help='Write cProfile output for each stage to outdir/profile/')
+    parser.add_argument('--manifest', help='Sample manifest TSV (sample, r1, r2[, lanes, input_bytes]) to use instead of scanning indir (optional)')
+    parser.add_argument('--scratch', help='Node-local directory (e.g. $TMPDIR or /dev/shm) for intermediate files; only final outputs are written to outdir (optional)')
+    parser.add_argument('--cleanup', action='store_true', help='Delete each intermediate file as soon as every stage using it has finished (always on with --scratch)')
+    parser.add_argument('--max_pairs', type=int, default=0, help='Cap each sample at this many read pairs after fastp by seeded reservoir sampling (0: no cap)')
+    parser.add_argument('--normalize', type=int, default=0, help='Digital normalization: drop read pairs whose median k-mer coverage already reaches this depth (0: off)')
+    parser.add_argument('--norm_k', type=int, default=NORM_K, help='k-mer length for --normalize (1-32)')
+    parser.add_argument('--subsample_seed', type=int, default=1, help='Random seed for --max_pairs')
+    parser.add_argument('--incremental', action='store_true', help='Add new samples to the existing Stacks catalog in outdir/pl (ustacks, cstacks, sstacks and tsv2bam run only for new samples) instead of rebuilding it')
+    parser.add_argument('--sweep', action='append', default=[], help='Parameter sweep as name=v1,v2,... for m, M, N or r, e.g. --sweep M=1,2,3 --sweep r=0.5,0.8 (repeatable); runs every combination and writes sweep_summary.tsv instead of the single Stacks/IQ-TREE analysis')
+    parser.add_argument('--max_sample_missing', type=float, default=1.0, help='Drop samples missing more than this fraction of alignment sites before IQ-TREE (1.0: keep all)')
+    parser.add_argument('--max_site_missing', type=float, default=1.0, help='Drop alignment sites missing in more than this fraction of the remaining samples (1.0: keep all)')
+    parser.add_argument('--keep_invariant', action='store_true', help='Keep invariant alignment sites (they are removed by default, as -m MFP+ASC requires)')
+    parser.add_argument('--iq_model', default='MFP+ASC', help='IQ-TREE -m; MFP, TEST or TESTNEW runs ModelFinder once, caches the selected model for this alignment and gives it to the tree search')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='IQ-TREE ultrafast bootstrap replicates (-bb, 0: none)')
+    parser.add_argument('--alrt', type=int, default=1000, help='IQ-TREE SH-aLRT replicates (--alrt, 0: none)')
+    parser.add_argument('--iq_seeds', type=int, default=1, help='Independent IQ-TREE searches with seeds 1..N run side by side within -t threads; the highest log-likelihood tree is kept')
+    parser.add_argument('--dedupe', action='store_true', help='Drop samples whose sequence duplicates an earlier one after site filtering')
+    parser.add_argument('--phylip_source', choices=['fixed', 'vcf'], default='fixed', help='Alignment given to IQ-TREE: populations.fixed.phylip or the SNPs of populations.snps.vcf after --min_maf/--min_call_rate/--max_obs_het')
+    parser.add_argument('--min_maf', type=float, default=0.0, help='Minimum minor allele frequency of a VCF locus (with --phylip_source vcf)')
+    parser.add_argument('--min_call_rate', type=float, default=0.0, help='Minimum fraction of samples genotyped at a VCF locus (with --phylip_source vcf)')
+    parser.add_argument('--max_obs_het', type=float, default=1.0, help='Maximum observed heterozygosity of a VCF locus (with --phylip_source vcf)')
+    parser.add_argument('--min_qc_reads', type=int, default=0, help='Exclude samples with fewer reads (R1+R2) left after fastp filtering from the Stacks analysis')
+    parser.add_argument('--min_q30_rate', type=float, default=0.0, help='Exclude samples whose Q30 rate after fastp filtering is below this value')
+    parser.add_argument('--max_dup_rate', type=float, default=1.0, help='Exclude samples whose fastp duplication rate is above this value')
+    parser.add_argument('--shard_count', type=int, default=0, help='Split the sample manifest into this many shards balanced by input size; a shard run only does the per-sample stages (0: no sharding)')
+    parser.add_argument('--shard_index', type=int, default=None, help='Shard to run, from 0 (default: the array task ID from SLURM_ARRAY_TASK_ID, PBS_ARRAY_INDEX, SGE_TASK_ID or LSB_JOBINDEX)')
+    parser.add_argument('--gather', action='store_true', help='Check that all --shard_count shards finished, then run Stacks and IQ-TREE on every sample')
+    parser.add_argument('--local_shards', action='store_true', help='Run all --shard_count shards as parallel local processes (-t threads each), then gather')
+    parser.add_argument('--history', default=None, help='SQLite run-history database that every run appends its stage and sample metrics to (default: $MIGSEQ2_HISTORY or ~/.migseq2/history.sqlite)')
+    parser.add_argument('--no_history', action='store_true', help='Do not record this run in the run history')
+    parser.add_argument('--project', default=None, help='Project name of this run in the run history (default: the input directory name)')
+    parser.add_argument('--keep_fa', action='store_true', help='Also write uncompressed FASTA files to fa/ (optional)')
+    return parser
+
+
+def main(argv=None, prog=None):
+    # 解析命令行参数
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = get_parser(prog).parse_args(argv)
+    if args.local_shards:
+        run_local_shards('denovo', argv, args.shard_count)
+
+    # 创建SampleCodeClass实例
+    sample_code = SampleCodeClass(
+        args.indir,
+        args.quality,
+        args.F_remove,
+        args.R_remove,
+        args.threads,
+        args.min_len,
+        args.outdir,
+        args.min_cov,
+        args.max_dist,
+        args.max_dist_secondary,
+        args.r,
+        args.pop_opts,
+        keep_fa=args.keep_fa,
+        tool_curves=parse_tool_curves(args.tool_curve),
+        force=args.force,
+        profile=args.profile,
+        manifest=args.manifest,
+        scratch=args.scratch,
+        cleanup=args.cleanup,
+        max_pairs=args.max_pairs,
+        normalize=args.normalize,
+        norm_k=args.norm_k,
+        subsample_seed=args.subsample_seed,
+        incremental=args.incremental,
+        sweep=parse_sweep(args.sweep),
+        max_sample_missing=args.max_sample_missing,
+        max_site_missing=args.max_site_missing,
+        keep_invariant=args.keep_invariant,
+        dedupe=args.dedupe,
+        phylip_source=args.phylip_source,
+        min_maf=args.min_maf,
+        min_call_rate=args.min_call_rate,
+        max_obs_het=args.max_obs_het,
+        min_qc_reads=args.min_qc_reads,
+        min_q30_rate=args.min_q30_rate,
+        max_dup_rate=args.max_dup_rate,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        gather=args.gather or args.local_shards,
+        iq_model=args.iq_model,
+        bootstrap=args.bootstrap,
+        alrt=args.alrt,
+        iq_seeds=args.iq_seeds,
+        history=None if args.no_history else history_path(args.history),
+        project=args.project,
+        run_params=vars(args)
+    )
+
+    # 运行分析流程
+    return sample_code.run(popmap=args.popmap, from_fa=args.from_fa)
@@ -0,0 +1,204 @@
+# 两个流程共用的FASTQ/FASTA读写模块
+# 以字节块为单位读取和转换记录，不为每条记录创建Python对象；
+# 输出为BGZF（分块gzip，可随机访问），压缩在工作线程中并行进行（zlib会释放GIL）
+import gzip
+import os
+import re
+import shutil
+import struct
+import zlib
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_BYTES = 1 << 22  # 每次读取的解压后字节数
+GZIP_LEVEL = 6  # 输出的压缩等级
+BGZF_BLOCK = 0xff00  # 每个BGZF块的最大未压缩字节数（与htslib相同）
+BGZF_BLOCKS_PER_TASK = 16  # 每个压缩任务包含的块数
+# BGZF的结束标记块
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+COPY_BLOCK = 1 << 24  # 合并lane时每次复制的字节数
+
+# 一条4行的FASTQ记录：标识、其余的标题、序列
+FASTQ_RECORD = re.compile(rb'@(\S*)([^\n]*)\n([^\n]*)\n\+[^\n]*\n[^\n]*\n')
+
+
+def open_input(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def read_chunks(path, size=CHUNK_BYTES, fasta=False):
+    # 按记录边界切分的字节块：FASTQ按4行一组，FASTA在下一个'>'之前切开
+    rest = b''
+    with open_input(path) as f:
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            buf = rest + data
+            if fasta:
+                cut = buf.rfind(b'\n>') + 1
+            else:
+                cut = buf.rfind(b'\n') + 1
+                for _ in range(buf.count(b'\n', 0, cut) % 4):
+                    cut = buf.rfind(b'\n', 0, cut - 1) + 1
+            if cut <= 0:
+                rest = buf
+                continue
+            yield buf[:cut]
+            rest = buf[cut:]
+    if rest.strip():
+        if not fasta and not rest.endswith(b'\n'):
+            rest += b'\n'
+        yield rest
+
+
+def fastq_records(path, size=CHUNK_BYTES):
+    # 每个字节块中的记录列表（每条记录为4行拼接的bytes）
+    for chunk in read_chunks(path, size):
+        records = [m.group(0) for m in FASTQ_RECORD.finditer(chunk)]
+        if len(records) * 4 != chunk.count(b'\n'):
+            raise ValueError(f"'{path}' 不是有效的4行FASTQ格式。")
+        yield records
+
+
+def fastq_pairs(fastq1, fastq2, size=CHUNK_BYTES):
+    # 逐对产生R1/R2记录；两个文件各自按块读取，记录数不一致时报错
+    chunks2 = fastq_records(fastq2, size)
+    pending = deque()
+    for records1 in fastq_records(fastq1, size):
+        for rec1 in records1:
+            if not pending:
+                pending.extend(next(chunks2, ()))
+                if not pending:
+                    raise ValueError(f"'{fastq2}' 的记录数少于 '{fastq1}'。")
+            yield rec1, pending.popleft()
+    if pending or next(chunks2, None):
+        raise ValueError(f"'{fastq2}' 的记录数多于 '{fastq1}'。")
+
+
+def count_fastq(path, size=CHUNK_BYTES):
+    # FASTQ记录数（只数换行符）
+    return sum(chunk.count(b'\n') for chunk in read_chunks(path, size)) // 4
+
+
+def bgzf_compress(data, level=GZIP_LEVEL):
+    # 把data压缩成连续的BGZF块；每块是带BC附加字段（块大小）的独立gzip成员
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK):
+        block = data[start:start + BGZF_BLOCK]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        header = struct.pack(
+            '<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(deflated) + 25)
+        blocks.append(header + deflated + struct.pack(
+            '<II', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+class BgzfWriter:
+    # 多线程BGZF写出器：写入的数据攒够若干块后交给线程池压缩，按提交顺序写出
+    # 同时在途的任务数有上限，内存占用与线程数成正比；threads为1时在当前线程压缩
+    def __init__(self, path, threads=1, level=GZIP_LEVEL):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.threads = max(1, threads)
+        self.task_bytes = BGZF_BLOCK * BGZF_BLOCKS_PER_TASK
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.task_bytes:
+            self._submit()
+
+    def _submit(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if not data:
+            return
+        if self.executor is None:
+            self.file.write(bgzf_compress(data, self.level))
+            return
+        self.pending.append(self.executor.submit(bgzf_compress, data, self.level))
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            self._submit()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+            self.file.write(BGZF_EOF)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fastq_to_fasta(sample, read_no, fastq_file, renamed_file, fasta_file=None,
+                   threads=1, size=CHUNK_BYTES):
+    # 单次流式读取FASTQ(.gz)，整块地用正则替换成重命名后的FASTA，写出BGZF压缩的renamed_file
+    # 序列名为 {sample}:{原标识}/{read_no}；fasta_file不为None时同时写出保留完整标题的未压缩FASTA
+    # 返回记录数
+    prefix = f'{sample}:'.replace('\\', '\\\\').encode()
+    renamed = b'>' + prefix + rb'\g<1>/' + str(read_no).encode() + rb'\n\g<3>\n'
+    n = 0
+    with BgzfWriter(renamed_file, threads) as out, \
+            (open(fasta_file, 'wb') if fasta_file else nullcontext()) as fa:
+        for chunk in read_chunks(fastq_file, size):
+            converted, count = FASTQ_RECORD.subn(renamed, chunk)
+            if count * 4 != chunk.count(b'\n'):
+                raise ValueError(f"'{fastq_file}' 不是有效的4行FASTQ格式。")
+            out.write(converted)
+            if fa is not None:
+                fa.write(FASTQ_RECORD.sub(rb'>\g<1>\g<2>\n\g<3>\n', chunk))
+            n += count
+    return n
+
+
+def write_fastq_pairs(pairs, out1, out2, threads=1, batch=8192):
+    # 把(R1, R2)记录对写成两个BGZF压缩的FASTQ；返回写出的对数
+    n = 0
+    batch1, batch2 = [], []
+    with BgzfWriter(out1, threads) as o1, BgzfWriter(out2, threads) as o2:
+        for rec1, rec2 in pairs:
+            batch1.append(rec1)
+            batch2.append(rec2)
+            if len(batch1) >= batch:
+                o1.write(b''.join(batch1))
+                o2.write(b''.join(batch2))
+                n += len(batch1)
+                batch1.clear()
+                batch2.clear()
+        o1.write(b''.join(batch1))
+        o2.write(b''.join(batch2))
+        n += len(batch1)
+    return n
+
+
+def concat_gzip(files, out_file):
+    # gzip允许多个成员直接首尾相接，按字节拼接即可合并lane，无需解压和重新压缩
+    # 优先使用copy_file_range在内核中复制（支持的文件系统上不经过用户空间）
+    tmp = out_file + '.tmp'
+    with open(tmp, 'wb', buffering=0) as out:
+        for fq in files:
+            with open(fq, 'rb', buffering=0) as src:
+                try:
+                    while os.copy_file_range(src.fileno(), out.fileno(), COPY_BLOCK):
+                        pass
+                except (AttributeError, OSError):
+                    shutil.copyfileobj(src, out, COPY_BLOCK)
+    os.replace(tmp, out_file)
+    return os.path.getsize(out_file)
@@ -0,0 +1,211 @@
+# 运行历史：每次运行结束时把阶段和样本的指标追加到本地SQLite数据库，按项目、样本和参数检索
+# migseq2 plan denovo|mapping [与运行相同的选项] 读取计划的样本清单，由过去的完整运行预测每个阶段的
+# 墙钟时间、峰值RSS和工作目录（scratch）的峰值占用，用于提交作业前申请资源
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from migseq2 import __version__
+from migseq2.core import SAMPLE_MANIFEST, discover_fastq, history_path, read_manifest
+
+
+# 不影响分析结果的选项（路径、线程数、缓存和运行方式），不计入参数键
+RUN_OPTIONS = {
+    'indir', 'outdir', 'threads', 't', 'manifest', 'scratch', 'cleanup', 'force', 'profile',
+    'history', 'no_history', 'project', 'shard_count', 'shard_index', 'gather', 'local_shards',
+    'popmap', 'from_fa', 'from_bam', 'tool_curve', 'ref_cache', 'keep_fa'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pipeline TEXT, project TEXT, params_key TEXT, params TEXT, version TEXT,
+    host TEXT, outdir TEXT, mode TEXT, status TEXT, threads INTEGER, scratch INTEGER,
+    samples INTEGER, input_bytes INTEGER, reads INTEGER, cache_hits INTEGER,
+    started REAL, wall REAL, peak_work_bytes INTEGER);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER, position INTEGER, stage TEXT, wall REAL, cpu REAL, peak_rss_kb INTEGER,
+    read_bytes INTEGER, write_bytes INTEGER, commands INTEGER);
+CREATE TABLE IF NOT EXISTS sample_stages (
+    run_id INTEGER, sample TEXT, stage TEXT, input_bytes INTEGER, wall REAL, cpu REAL,
+    peak_rss_kb INTEGER, read_bytes INTEGER, write_bytes INTEGER, reads INTEGER);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (pipeline, params_key);
+CREATE INDEX IF NOT EXISTS runs_project ON runs (project);
+CREATE INDEX IF NOT EXISTS sample_stages_sample ON sample_stages (sample);
+"""
+
+
+def run_params(options):
+    # 参数键的内容：命令行选项（字典）中影响分析结果的部分
+    return {name: value for name, value in sorted(options.items()) if name not in RUN_OPTIONS}
+
+
+def params_key(params):
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # 分片等并行的运行可能同时写入同一个数据库
+    conn = sqlite3.connect(path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_run(path, pipeline, project, params, metrics, threads, mode, status, scratch,
+               cache_hits, peak_work_bytes, outdir):
+    # 追加一次运行：runs一行，stages每个阶段一行，sample_stages每个样本的每个阶段一行
+    sizes = {row['sample']: row['input_bytes'] for row in metrics.sample_order}
+    reads = {
+        sample: max([values.get('reads', 0) for values in stages.values()], default=0)
+        for sample, stages in metrics.samples.items()}
+    conn = connect(path)
+    try:
+        with conn:
+            run_id = conn.execute(
+                'INSERT INTO runs (pipeline, project, params_key, params, version, host, outdir, mode,'
+                ' status, threads, scratch, samples, input_bytes, reads, cache_hits, started, wall,'
+                ' peak_work_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (pipeline, project, params_key(params), json.dumps(params, sort_keys=True, default=str),
+                 __version__, os.uname().nodename, os.path.abspath(outdir), mode, status, threads,
+                 int(scratch), len(sizes), sum(sizes.values()), sum(reads.values()), cache_hits,
+                 metrics.started, time.time() - metrics.started, peak_work_bytes)).lastrowid
+            conn.executemany(
+                'INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, position, stage['stage'], stage['wall'],
+                  stage['cpu_self'] + stage['cpu_children'],
+                  max(stage['peak_rss_self_kb'], stage['peak_rss_children_kb']),
+                  stage['read_bytes'], stage['write_bytes'], stage['commands'])
+                 for position, stage in enumerate(metrics.stages)])
+            conn.executemany(
+                'INSERT INTO sample_stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, sample, stage, sizes.get(sample, 0), values.get('wall', 0),
+                  values.get('cpu', 0), values.get('peak_rss_kb', 0), values.get('read_bytes', 0),
+                  values.get('write_bytes', 0), values.get('reads', 0))
+                 for sample, stages in sorted(metrics.samples.items())
+                 for stage, values in stages.items()])
+    finally:
+        conn.close()
+    return run_id
+
+
+def predict(points, x):
+    # 由历史运行的(输入字节数, 值)预测输入为x字节时的值：有两个以上不同的输入大小时用最小二乘直线
+    # （截距和斜率不为负），否则按输入大小等比例缩放
+    n = len(points)
+    mean_x = sum(p[0] for p in points) / n
+    mean_y = sum(p[1] for p in points) / n
+    sxx = sum((p[0] - mean_x) ** 2 for p in points)
+    if sxx > 0:
+        slope = max(0.0, sum((p[0] - mean_x) * (p[1] - mean_y) for p in points) / sxx)
+        return max(0.0, mean_y - slope * mean_x) + slope * x
+    return mean_y * x / mean_x if mean_x else mean_y
+
+
+def basis_runs(conn, pipeline, key, threads):
+    # 预测使用的历史运行：同一流程中成功结束、没有命中阶段缓存的完整运行，
+    # 依次优先参数和线程数都相同、参数相同、线程数相同的运行（至少两次时采用该层）
+    rows = conn.execute(
+        "SELECT run_id, params_key, threads, scratch, input_bytes, wall, peak_work_bytes FROM runs"
+        " WHERE pipeline = ? AND status = 'ok' AND mode = 'full' AND cache_hits = 0 AND samples > 0",
+        (pipeline,)).fetchall()
+    tiers = [
+        [r for r in rows if r[1] == key and r[2] == threads],
+        [r for r in rows if r[1] == key],
+        [r for r in rows if r[2] == threads],
+        rows]
+    return next((tier for tier in tiers if len(tier) >= 2), next((tier for tier in tiers if tier), []))
+
+
+def plan(path, pipeline, params, threads, scratch, sizes):
+    # 返回 (采用的运行数, [(阶段, 预测墙钟秒数, 历史峰值RSS KB)], 预测总墙钟秒数, 预测工作目录峰值字节数)
+    total = sum(sizes.values())
+    if not os.path.exists(path):
+        return 0, [], None, None
+    conn = connect(path)
+    try:
+        runs = basis_runs(conn, pipeline, params_key(params), threads)
+        if not runs:
+            return 0, [], None, None
+        by_id = {r[0]: r for r in runs}
+        marks = ','.join('?' * len(by_id))
+        stage_rows = conn.execute(
+            f'SELECT run_id, position, stage, wall, peak_rss_kb FROM stages WHERE run_id IN ({marks})',
+            list(by_id)).fetchall()
+    finally:
+        conn.close()
+    points = {}
+    order = {}
+    rss = {}
+    for run_id, position, stage, wall, peak_rss_kb in stage_rows:
+        points.setdefault(stage, []).append((by_id[run_id][4], wall))
+        order.setdefault(stage, []).append(position)
+        rss[stage] = max(rss.get(stage, 0), peak_rss_kb)
+    stages = [
+        (stage, predict(points[stage], total), rss[stage])
+        for stage in sorted(points, key=lambda stage: sum(order[stage]) / len(order[stage]))]
+    wall = predict([(r[4], r[5]) for r in runs], total)
+    # 工作目录峰值优先参考scratch设置相同的运行
+    work = [r for r in runs if r[3] == int(scratch)] or runs
+    peak_work = predict([(r[4], r[6]) for r in work], total)
+    return len(runs), stages, wall, peak_work
+
+
+def planned_sizes(args):
+    # 计划运行的样本输入大小：--manifest、outdir中已有的samples.tsv或扫描indir
+    manifest = args.manifest
+    if manifest is None and os.path.exists(os.path.join(args.outdir, SAMPLE_MANIFEST)):
+        manifest = os.path.join(args.outdir, SAMPLE_MANIFEST)
+    if manifest is not None:
+        rows = read_manifest(manifest)
+        return {
+            sample: row['input_bytes'] or sum(
+                os.path.getsize(os.path.join(args.indir, fq))
+                for fq in row['r1'] + row['r2'] if os.path.exists(os.path.join(args.indir, fq)))
+            for sample, row in rows.items()}
+    return {
+        sample: sum(os.path.getsize(os.path.join(args.indir, fq)) for fq in r1 + r2)
+        for sample, (r1, r2) in discover_fastq(args.indir).items()}
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def main(argv=None, prog=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Predict per-stage wall time, peak RSS and peak work-directory usage of a run from the run history',
+        epilog='Give the same options as the planned run, e.g. "migseq2 plan denovo -i raw -o output -t 8".')
+    parser.add_argument('pipeline', choices=['denovo', 'mapping'], help='Pipeline of the planned run')
+    parser.add_argument('options', nargs=argparse.REMAINDER, help='Options of the planned run')
+    args = parser.parse_args(argv)
+    module = importlib.import_module(f'migseq2.{args.pipeline}')
+    run_args = module.get_parser(f'{prog} {args.pipeline}').parse_args(args.options)
+    sizes = planned_sizes(run_args)
+    if not sizes:
+        print('计划的运行中没有样本。')
+        return 1
+    threads = getattr(run_args, 'threads', None) or run_args.t
+    path = history_path(run_args.history)
+    n_runs, stages, wall, peak_work = plan(
+        path, args.pipeline, run_params(vars(run_args)), threads, run_args.scratch is not None, sizes)
+    print(f'{len(sizes)} 个样本，输入共 {format_bytes(sum(sizes.values()))}，{threads} 线程')
+    if not n_runs:
+        print(f"运行历史 '{path}' 中没有可参考的 {args.pipeline} 完整运行。")
+        return 1
+    print(f'参考 {n_runs} 次历史运行')
+    print(f'{"stage":<32}{"wall (s)":>12}{"peak RSS":>12}')
+    for stage, seconds, rss_kb in stages:
+        print(f'{stage:<32}{seconds:>12.1f}{format_bytes(rss_kb * 1024):>12}')
+    print(f'{"total":<32}{wall:>12.1f}')
+    print(f'工作目录峰值占用: {format_bytes(peak_work)}')
+    return 0
@@ -0,0 +1,528 @@
+# Migseq2 mapping pipeline: fastp -> bwa mem against a reference -> Stacks
+# gstacks/populations -> IQ-TREE
+import argparse
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from migseq2.core import (
+    Pipeline, history_path, instrumented, parse_tool_curves, run_local_shards, tool_version)
+
+
+REF_CACHE_ENV = 'MIGSEQ2_REF_CACHE'  # default for --ref_cache
+REF_CACHE_DEFAULT = os.path.join('~', '.cache', 'migseq2', 'refs')
+REF_FASTA = 'ref.fasta'  # reference copy inside each cache entry
+REF_MARKER = 'complete.json'  # written last, an entry without it is unfinished
+REF_HASH_BLOCK = 1 << 24
+
+
+class ReferenceCache:
+    # shared reference index cache keyed by the sha256 of the FASTA contents;
+    # each entry holds a private copy of the FASTA with its bwa index, .fai and
+    # .dict, so any project using the same sequence reuses it however the file is named
+    def __init__(self, root=None):
+        root = root or os.environ.get(REF_CACHE_ENV) or REF_CACHE_DEFAULT
+        self.root = os.path.abspath(os.path.expanduser(root))
+        os.makedirs(self.root, exist_ok=True)
+        self.digests = os.path.join(self.root, 'digests.json')
+
+    @contextmanager
+    def lock(self, name):
+        # flock is released by the kernel if the holder dies, so a crashed
+        # run never leaves a stale lock behind
+        with open(os.path.join(self.root, f'{name}.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def digest(self, fasta):
+        # hashing a large assembly takes a while, so digests are remembered per
+        # path and only recomputed when the file's size, mtime or inode changes
+        st = os.stat(fasta)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        path = os.path.abspath(fasta)
+        with self.lock('digests'):
+            known = {}
+            if os.path.exists(self.digests):
+                with open(self.digests) as f:
+                    known = json.load(f)
+            entry = known.get(path)
+            if entry is not None and entry['stamp'] == stamp:
+                return entry['sha256']
+        h = hashlib.sha256()
+        with open(fasta, 'rb') as f:
+            for block in iter(functools.partial(f.read, REF_HASH_BLOCK), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock('digests'):
+            if os.path.exists(self.digests):
+                with open(self.digests) as f:
+                    known = json.load(f)
+            known[path] = {'stamp': stamp, 'sha256': digest}
+            tmp = f'{self.digests}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(known, f, indent=1)
+            os.replace(tmp, self.digests)
+        return digest
+
+    def entry(self, digest):
+        return os.path.join(self.root, digest)
+
+    def fasta(self, digest):
+        return os.path.join(self.entry(digest), REF_FASTA)
+
+    def ready(self, digest):
+        return os.path.exists(os.path.join(self.entry(digest), REF_MARKER))
+
+
+# samtools flagstat -O tsv descriptions (samtools 1.13+) and the mapping QC
+# columns they fill; both columns (QC-passed and QC-failed) are added up
+FLAGSTAT_FIELDS = {
+    'primary': 'total',
+    'mapped': 'mapped',
+    'primary mapped': 'primary_mapped',
+    'properly paired': 'properly_paired',
+}
+
+
+def parse_flagstat(output):
+    counts = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[2] in FLAGSTAT_FIELDS:
+            counts[FLAGSTAT_FIELDS[fields[2]]] = int(fields[0]) + int(fields[1])
+    missing = [name for name in FLAGSTAT_FIELDS.values() if name not in counts]
+    if missing:
+        raise RuntimeError(
+            f"samtools flagstat output has no {', '.join(missing)} counts (samtools 1.13 or newer is needed)")
+    return counts
+
+
+class SampleCodeClass(Pipeline):
+    pipeline = "mapping"  # pipeline name in the run history
+
+    def __init__(
+            self, indir, q, fada, rada,
+            F_remove, R_remove, t, min_len,
+            ref_genome, outdir, r, pop_opts, tool_curves=None,
+            force=False, sort_mem='768M', sort_threads=2, tmpdir=None,
+            min_mapq=0, min_mapped_reads=1, min_mapped_frac=0.0,
+            profile=False, manifest=None, scratch=None, cleanup=False, ref_cache=None,
+            max_sample_missing=1.0, max_site_missing=1.0, keep_invariant=False, dedupe=False,
+            phylip_source='fixed', min_maf=0.0, min_call_rate=0.0, max_obs_het=1.0,
+            shard_index=None, shard_count=0, gather=False, iq_model="MFP+ASC", bootstrap=1000,
+            alrt=1000, iq_seeds=1, history=None, project=None, run_params=None):
+        super().__init__(
+            indir, outdir, q, F_remove, R_remove, t, min_len, r, pop_opts,
+            fada=fada, rada=rada, tool_curves=tool_curves, force=force, profile=profile,
+            manifest=manifest, scratch=scratch, cleanup=cleanup,
+            max_sample_missing=max_sample_missing, max_site_missing=max_site_missing,
+            keep_invariant=keep_invariant, dedupe=dedupe, phylip_source=phylip_source,
+            min_maf=min_maf, min_call_rate=min_call_rate, max_obs_het=max_obs_het,
+            shard_index=shard_index, shard_count=shard_count, gather=gather, iq_model=iq_model,
+            bootstrap=bootstrap, alrt=alrt, iq_seeds=iq_seeds, history=history, project=project,
+            run_params=run_params)
+        self.ref_genome = ref_genome
+        # indexed copy of ref_genome in the shared cache (set by genome_index)
+        self.ref_cache = ReferenceCache(ref_cache)
+        self.ref_digest = None
+        self.ref_index = None
+        self.path_to_stacks = "/usr/local/src/stacks-2.64"
+        # gstacks/populations write straight into outdir
+        self.stacks_out = outdir
+        self.alignment_file = os.path.join(outdir, 'pop.phylip')
+        # samtools sort memory per thread, extra sort threads and scratch dir for temp files
+        self.sort_mem = sort_mem
+        self.sort_threads = sort_threads
+        self.tmpdir = tmpdir or os.path.join(self.workdir, 'bam')
+        # sample exclusion thresholds applied to the mapping QC table
+        self.min_mapq = min_mapq
+        self.min_mapped_reads = min_mapped_reads
+        self.min_mapped_frac = min_mapped_frac
+        self.stacks_key = None
+        self.mapping_qc = {}
+        self.index_lock = threading.Lock()
+        self.indexed = False
+
+    def fastp_consumers(self):
+        return ['mapping']
+
+    def sample_qc(self):
+        return self.mapping_qc
+
+    def cohort_inputs(self, sample):
+        # gstacks reads the final BAM copies in outdir/bam
+        return [os.path.join(self.outdir, 'bam', f'{sample}.bam')]
+
+    def map_sample(self, sample):
+        # stream bwa mem straight into a coordinate-sorted, indexed BAM
+        self.ensure_index()
+        bamdir = os.path.join(self.workdir, 'bam')
+        os.makedirs(bamdir, exist_ok=True)
+        os.makedirs(self.tmpdir, exist_ok=True)
+        # samtools sort reads and spills runs while bwa is still writing, so its
+        # threads come out of the same budget as the bwa threads
+        budget = self.scheduler.budget
+        sort_threads = min(self.sort_threads, budget - 1)
+        threads, _ = self.scheduler.plan('bwa', len(self.samples))
+        threads = min(threads, budget - sort_threads)
+        params = {
+            'ref': self.ref_digest,
+            'bwa': tool_version(self.path_to_bwa),
+            'samtools': tool_version(f'{self.path_to_samtools} --version'),
+        }
+        key = self.cache.key('mapping', params, upstream=[self.keys.get(sample)])
+        # output file
+        bamfile = os.path.join(bamdir, f'{sample}.bam')
+        # BAMs are final outputs: on scratch the local copy is only kept for counting
+        if self.workdir != self.outdir:
+            self.retention.produce('mapping', sample, [bamfile, f'{bamfile}.bai'], ['count'])
+        outputs = self.cache.hit('mapping', sample, key, released=sample not in self.restoring)
+        if outputs is not None:
+            self.samples[sample] = outputs
+            self.keys[sample] = key
+            self.retention.consume('fastp', sample, 'mapping')
+            return
+        # input files
+        rpf, rer = self.require(sample, self.samples[sample])
+        # per-sample temp dir so concurrent sorts never share a prefix
+        tmp = tempfile.mkdtemp(prefix=f'{sample}.', dir=self.tmpdir)
+        cmd = f"set -o pipefail; {self.path_to_bwa} mem -t {threads} {self.ref_index} {rpf} {rer}"
+        cmd += f" | {self.path_to_samtools} sort -@ {sort_threads} -m {self.sort_mem}"
+        cmd += f" -T {os.path.join(tmp, sample)} -o {bamfile} -"
+        cmd += f" && {self.path_to_samtools} index {bamfile}"
+        try:
+            with self.scheduler.reserve(threads + sort_threads, self.rank.get(sample, 0)):
+                self.execute_cmd(cmd, stage='mapping', sample=sample)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.keep_final([bamfile, f'{bamfile}.bai'], 'bam')
+        self.cache.record('mapping', sample, key, [bamfile, f'{bamfile}.bai'])
+        self.samples[sample] = [bamfile, f'{bamfile}.bai']
+        self.keys[sample] = key
+        self.retention.consume('fastp', sample, 'mapping')
+
+    def count_sample(self, sample):
+        # read accounting for one BAM with samtools; the counts are kept
+        # in the stage cache so deleted BAMs need no recount
+        key = self.cache.key(
+            'count', {'min_mapq': self.min_mapq}, upstream=[self.keys.get(sample)])
+        if self.cache.hit('count', sample, key) is not None:
+            self.mapping_qc[sample] = dict(self.cache.meta('count', sample))
+            self.retention.consume('mapping', sample, 'count')
+            return
+        bamfile = self.samples[sample][0]
+        if not os.path.exists(bamfile):
+            # the scratch copy is gone, count the final copy in outdir
+            bamfile = os.path.join(self.outdir, 'bam', os.path.basename(bamfile))
+        threads, _ = self.scheduler.plan('samtools', len(self.samples))
+        with self.scheduler.reserve(threads, self.rank.get(sample, 0)):
+            count = self.bam_read_counts(sample, bamfile, threads)
+        self.metrics.add_sample('exclude_multi_unmapped_reads', sample, reads=count['total'])
+        self.mapping_qc[sample] = count
+        self.cache.record('count', sample, key, [], meta=count)
+        self.retention.consume('mapping', sample, 'count')
+
+    def bam_read_counts(self, sample, bamfile, threads):
+        # one flagstat pass gives the primary, mapped and properly paired counts;
+        # the MAPQ count needs a second pass and only runs when --min_mapq is set
+        cmd = f"{self.path_to_samtools} flagstat -@ {threads - 1} -O tsv {bamfile}"
+        if self.min_mapq > 0:
+            cmd += f" && {self.path_to_samtools} view -c -@ {threads - 1} -F 0x904 -q {self.min_mapq} {bamfile}"
+        output = self.execute_cmd(cmd, stage='exclude_multi_unmapped_reads', sample=sample)
+        count = parse_flagstat(output)
+        if self.min_mapq > 0:
+            count['mapq_filtered'] = int(output.split()[-1])
+        else:
+            count['mapq_filtered'] = count['primary_mapped']
+        return count
+
+    def ensure_index(self):
+        # the first sample to reach mapping builds the index, the others wait for it
+        with self.index_lock:
+            if not self.indexed:
+                self.genome_index()
+                self.indexed = True
+
+    @instrumented
+    def genome_index(self):
+        # look the reference up by content; the first run to need an entry builds
+        # it under a lock while concurrent runs wait and then reuse it
+        digest = self.ref_cache.digest(self.ref_genome)
+        if not self.ref_cache.ready(digest):
+            with self.ref_cache.lock(digest):
+                if not self.ref_cache.ready(digest):
+                    self.build_reference(digest)
+                else:
+                    self.logger.info(f"Reference index {digest[:12]} was built by another run.")
+        else:
+            self.logger.info(f"Using cached reference index {self.ref_cache.entry(digest)}")
+        self.ref_digest = digest
+        self.ref_index = self.ref_cache.fasta(digest)
+
+    def build_reference(self, digest):
+        # build in a temp dir next to the entry and rename it into place, so
+        # an interrupted build never looks like a finished one
+        entry = self.ref_cache.entry(digest)
+        self.logger.info(f"Indexing reference '{self.ref_genome}' into {entry}")
+        tmp = tempfile.mkdtemp(prefix=f'{digest}.', dir=self.ref_cache.root)
+        try:
+            fasta = os.path.join(tmp, REF_FASTA)
+            # a copy rather than a link: editing the original must not change the entry
+            shutil.copyfile(self.ref_genome, fasta)
+            final = os.path.join(entry, REF_FASTA)
+            cmd = f"{self.path_to_bwa} index {fasta}"
+            cmd += f" && {self.path_to_samtools} faidx {fasta}"
+            cmd += f" && {self.path_to_samtools} dict -u file://{final} -o {os.path.join(tmp, 'ref.dict')} {fasta}"
+            with self.scheduler.reserve(1):
+                self.execute_cmd(cmd, stage='genome_index')
+            with open(os.path.join(tmp, REF_MARKER), 'w') as f:
+                json.dump({
+                    'sha256': digest,
+                    'source': os.path.abspath(self.ref_genome),
+                    'bwa': tool_version(self.path_to_bwa),
+                    'samtools': tool_version(f'{self.path_to_samtools} --version'),
+                    'time': time.time(),
+                }, f, indent=1)
+            # only reachable without a marker, i.e. left over from an older layout
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @instrumented
+    def sample_stages(self):
+        # per-sample pipeline: a sample is mapped and counted as soon as its own
+        # fastp run has finished; the index is built while other samples run fastp
+        self.sample_steps = [self.merge_sample, self.fastp_sample, self.map_sample, self.count_sample]
+        self.run_samples(self.sample_steps)
+
+    @instrumented
+    def exclude_multi_unmapped_reads(self):
+        # write mapping_qc.tsv and drop samples below the thresholds; BAMs that
+        # were not counted in sample_stages are counted here in parallel
+        samples = list(self.samples.keys())
+        missing = [sample for sample in samples if sample not in self.mapping_qc]
+        if missing:
+            self.run_samples([self.count_sample], samples=missing)
+        excluded = []
+        self.samples_for_analysis = {}
+        for sample in samples:
+            count = self.mapping_qc[sample]
+            frac = count['primary_mapped'] / count['total'] if count['total'] else 0.0
+            count['mapped_frac'] = frac
+            count['excluded'] = (
+                count['mapq_filtered'] < self.min_mapped_reads
+                or frac < self.min_mapped_frac)
+            if count['excluded']:
+                excluded.append(sample)
+            else:
+                self.samples_for_analysis[sample] = self.samples[sample]
+        columns = ['total', 'mapped', 'primary_mapped', 'mapq_filtered',
+                   'properly_paired', 'mapped_frac', 'excluded']
+        with open(os.path.join(self.outdir, 'mapping_qc.tsv'), 'w') as f:
+            f.write('sample\t' + '\t'.join(columns) + '\n')
+            for sample in samples:
+                count = self.mapping_qc[sample]
+                row = [f'{count[c]:.4f}' if c == 'mapped_frac' else str(count[c]) for c in columns]
+                f.write(sample + '\t' + '\t'.join(row) + '\n')
+        for excluded_sample in excluded:
+            print("excluded sample:", excluded_sample)
+
+    @instrumented
+    def gstacks(self, from_bam=None):
+        bamdir = os.path.join(self.outdir, 'bam')
+        if from_bam is not None:
+            bamdir=from_bam
+            inputs = sorted(os.path.join(bamdir, f) for f in os.listdir(bamdir))
+            upstream = []
+        else:
+            inputs = []
+            upstream = [self.keys.get(sample) for sample in sorted(self.samples_for_analysis)]
+        params = {'version': tool_version(f'{self.path_to_stacks}/gstacks --version')}
+        key = self.cache.key('gstacks', params, inputs=inputs + [self.popmap], upstream=upstream)
+        self.stacks_key = key
+        if self.cache.hit('gstacks', 'all', key) is not None:
+            self.logger.info('gstacks inputs are unchanged, skipped.')
+            return
+        cmd = f"{self.path_to_stacks}/gstacks -I {bamdir} -M {self.popmap} -O {self.outdir} -t {self.t}"
+        self.execute_cmd(cmd, stage='gstacks')
+        self.cache.record('gstacks', 'all', key, [os.path.join(self.outdir, 'catalog.calls')])
+
+    @instrumented
+    def populations(self):
+        cmd = f"{self.path_to_stacks}/populations -P {self.outdir} -M {self.popmap} -R {self.r}  --max-obs-het 0.99 --min-maf 0.01 --vcf --structure --treemix --hwe --plink --genepop --phylip -t {self.t}"
+        if len(self.pop_opts) > 0:
+            cmd += f' {self.pop_opts}'
+        params = {
+            'r': self.r, 'pop_opts': self.pop_opts,
+            'version': tool_version(f'{self.path_to_stacks}/populations --version'),
+        }
+        key = self.cache.key('populations', params, upstream=[self.stacks_key])
+        if self.cache.hit('populations', 'all', key) is not None:
+            self.logger.info('populations inputs are unchanged, skipped.')
+            return
+        self.execute_cmd(cmd, stage='populations')
+        self.cache.record(
+            'populations', 'all', key, [os.path.join(self.outdir, 'populations.fixed.phylip')])
+
+    def run(self, popmap=None, from_bam=None):
+        try:
+            if from_bam is not None:
+                print('从BAM文件开始')
+                if popmap is None:
+                    print('请输入popmap文件')
+                    sys.exit(1)
+                self.popmap = popmap
+                self.gstacks(from_bam=from_bam)
+                self.populations()
+                self.md_phylip()
+                self.iqtree()
+                self.clean_scratch()
+                return 0
+
+            if self.ini is None:
+                self.make_sample_ini()
+            self.load_ini()
+            if self.shard_index is not None:
+                # shard run: per-sample stages for this shard only, then the done marker
+                self.select_shard()
+                self.sample_stages()
+                self.write_shard_marker()
+                self.clean_scratch()
+                return 0
+            print(self.samples)
+            if self.gather:
+                self.gather_shards()
+            else:
+                self.sample_stages()
+            self.exclude_multi_unmapped_reads()
+            self.pop_map_out()
+            self.gstacks()
+            self.populations()
+            self.md_phylip()
+            self.iqtree()
+            self.clean_scratch()
+        finally:
+            self.metrics.storage = {
+                'workdir': self.workdir, 'freed_bytes': self.retention.freed_bytes}
+            self.metrics.write()
+            self.record_history('failed' if sys.exc_info()[0] else 'ok')
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Migseq2 reference mapping pipeline (fastp, bwa mem, Stacks gstacks/populations, IQ-TREE)")
+    parser.add_argument("--indir", type=str, default="rawdata", help="Input directory")
+    parser.add_argument("--ref_genome", type=str, default="./refgenome/RedCoralContigSpades.fasta", help="Reference genome")
+    parser.add_argument("--q", type=int, default= 30, help="quality_value")
+    parser.add_argument("--F_remove", type=int, default= 0, help="forward_remove_bp")
+    parser.add_argument("--R_remove", type=int, default= 15, help="reverse_remove_bp")
+    parser.add_argument("--outdir", type=str, default="outdir", help="Output directory")
+    parser.add_argument("-t", type=int, default=4, help="Number of threads")
+    parser.add_argument("--fada", type=str, default="GTCAGATCGGAAGAGCACACGTCTGAACTCCAGTCAC", help="fada value")
+    parser.add_argument("--rada", type=str, default="CAGAGATCGGAAGAGCGTCGTGTAGGGAAAGAC", help="rada value")
+    parser.add_argument("--min_len", type=int, default=80, help="Minimum length")
+    parser.add_argument("-r", type=float, default=0.7, help="r value")
+    parser.add_argument("--popmap", type=str, default=None, help="Population map file")
+    parser.add_argument("--from_bam", type=str, default=None, help="BAM file directory")
+    parser.add_argument("--manifest", type=str, default=None, help="Sample manifest TSV (sample, r1, r2[, lanes, input_bytes]) to use instead of scanning indir")
+    parser.add_argument("--scratch", type=str, default=None, help="Node-local directory (e.g. $TMPDIR or /dev/shm) for intermediate files; only final outputs are written to outdir")
+    parser.add_argument("--cleanup", action="store_true", help="Delete each intermediate file as soon as every stage using it has finished (always on with --scratch)")
+    parser.add_argument("--force", action="store_true", help="Ignore the stage cache in outdir and rerun every stage")
+    parser.add_argument("--sort_mem", type=str, default="768M", help="Memory per samtools sort thread")
+    parser.add_argument("--sort_threads", type=int, default=2, help="Additional samtools sort threads per sample, taken from the -t budget together with the bwa threads")
+    parser.add_argument("--ref_cache", type=str, default=None, help=f"Shared directory of reference indexes keyed by FASTA content (default: ${REF_CACHE_ENV} or {REF_CACHE_DEFAULT})")
+    parser.add_argument("--tmpdir", type=str, default=None, help="Directory for samtools sort temp files (default: the bam directory under --scratch or outdir)")
+    parser.add_argument("--min_mapq", type=int, default=0, help="MAPQ cutoff for the mapq_filtered count in mapping_qc.tsv and --min_mapped_reads (default 0: every primary mapped read counts, and no extra pass over the BAM is made)")
+    parser.add_argument("--min_mapped_reads", type=int, default=1, help="Exclude samples with fewer primary mapped reads passing --min_mapq (default 1: samples with no primary mapped reads are excluded)")
+    parser.add_argument("--min_mapped_frac", type=float, default=0.0, help="Exclude samples whose primary mapped fraction is below this value")
+    parser.add_argument("--max_sample_missing", type=float, default=1.0, help="Drop samples missing more than this fraction of alignment sites before IQ-TREE (1.0: keep all)")
+    parser.add_argument("--max_site_missing", type=float, default=1.0, help="Drop alignment sites missing in more than this fraction of the remaining samples (1.0: keep all)")
+    parser.add_argument("--keep_invariant", action="store_true", help="Keep invariant alignment sites (they are removed by default, as -m MFP+ASC requires)")
+    parser.add_argument("--iq_model", default="MFP+ASC", help="IQ-TREE -m; MFP, TEST or TESTNEW runs ModelFinder once, caches the selected model for this alignment and gives it to the tree search")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="IQ-TREE ultrafast bootstrap replicates (-bb, 0: none)")
+    parser.add_argument("--alrt", type=int, default=1000, help="IQ-TREE SH-aLRT replicates (--alrt, 0: none)")
+    parser.add_argument("--iq_seeds", type=int, default=1, help="Independent IQ-TREE searches with seeds 1..N run side by side within -t threads; the highest log-likelihood tree is kept")
+    parser.add_argument("--dedupe", action="store_true", help="Drop samples whose sequence duplicates an earlier one after site filtering")
+    parser.add_argument("--phylip_source", choices=["fixed", "vcf"], default="fixed", help="Alignment given to IQ-TREE: populations.fixed.phylip or the SNPs of populations.snps.vcf after --min_maf/--min_call_rate/--max_obs_het")
+    parser.add_argument("--min_maf", type=float, default=0.0, help="Minimum minor allele frequency of a VCF locus (with --phylip_source vcf)")
+    parser.add_argument("--min_call_rate", type=float, default=0.0, help="Minimum fraction of samples genotyped at a VCF locus (with --phylip_source vcf)")
+    parser.add_argument("--max_obs_het", type=float, default=1.0, help="Maximum observed heterozygosity of a VCF locus (with --phylip_source vcf)")
+    parser.add_argument("--profile", action="store_true", help="Write cProfile output for each stage to outdir/profile/")
+    parser.add_argument("--shard_count", type=int, default=0, help="Split the sample manifest into this many shards balanced by input size; a shard run only does the per-sample stages (0: no sharding)")
+    parser.add_argument("--shard_index", type=int, default=None, help="Shard to run, from 0 (default: the array task ID from SLURM_ARRAY_TASK_ID, PBS_ARRAY_INDEX, SGE_TASK_ID or LSB_JOBINDEX)")
+    parser.add_argument("--gather", action="store_true", help="Check that all --shard_count shards finished, then run gstacks, populations and IQ-TREE on every sample")
+    parser.add_argument("--local_shards", action="store_true", help="Run all --shard_count shards as parallel local processes (-t threads each), then gather")
+    parser.add_argument("--history", default=None, help="SQLite run-history database that every run appends its stage and sample metrics to (default: $MIGSEQ2_HISTORY or ~/.migseq2/history.sqlite)")
+    parser.add_argument("--no_history", action="store_true", help="Do not record this run in the run history")
+    parser.add_argument("--project", default=None, help="Project name of this run in the run history (default: the input directory name)")
+    parser.add_argument("--tool_curve", action="append", default=[], help="Tool efficiency curve as tool=p[:max_threads], e.g. fastp=0.8:4 (repeatable)")
+    parser.add_argument(
+        "-pop_opts", '--populations_options', dest='popo',
+        type=str,
+        default='',
+        help='populations command additional options')
+    return parser
+
+
+def main(argv=None, prog=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = get_parser(prog).parse_args(argv)
+    if args.local_shards:
+        run_local_shards("mapping", argv, args.shard_count)
+
+    SCC = SampleCodeClass(
+        indir=args.indir,
+        ref_genome=args.ref_genome,
+        q=args.q,
+        F_remove=args.F_remove,
+        R_remove=args.R_remove,
+        outdir=args.outdir,
+        t=args.t,
+        fada=args.fada,
+        rada=args.rada,
+        min_len=args.min_len,
+        r=args.r,
+        pop_opts=args.popo,
+        tool_curves=parse_tool_curves(args.tool_curve),
+        force=args.force,
+        sort_mem=args.sort_mem,
+        sort_threads=args.sort_threads,
+        tmpdir=args.tmpdir,
+        min_mapq=args.min_mapq,
+        min_mapped_reads=args.min_mapped_reads,
+        min_mapped_frac=args.min_mapped_frac,
+        profile=args.profile,
+        manifest=args.manifest,
+        scratch=args.scratch,
+        cleanup=args.cleanup,
+        ref_cache=args.ref_cache,
+        max_sample_missing=args.max_sample_missing,
+        max_site_missing=args.max_site_missing,
+        keep_invariant=args.keep_invariant,
+        dedupe=args.dedupe,
+        phylip_source=args.phylip_source,
+        min_maf=args.min_maf,
+        min_call_rate=args.min_call_rate,
+        max_obs_het=args.max_obs_het,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        gather=args.gather or args.local_shards,
+        iq_model=args.iq_model,
+        bootstrap=args.bootstrap,
+        alrt=args.alrt,
+        iq_seeds=args.iq_seeds,
+        history=None if args.no_history else history_path(args.history),
+        project=args.project,
+        run_params=vars(args)
+    )
+    return SCC.run(popmap=args.popmap, from_bam=args.from_bam)
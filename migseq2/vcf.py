@@ -0,0 +1,184 @@
+# 两个流程共用的VCF基因型矩阵模块
+# populations.snps.vcf按块流式读取，基因型写成磁盘上的int8矩阵（位点 x 样本，ALT等位基因数0/1/2，缺失为-1），
+# 之后以内存映射打开，统计和过滤都按位点块向量化计算，内存占用与位点数无关
+import os
+import tempfile
+
+import numpy as np
+
+from migseq2.align import MMAP_BYTES
+
+
+LOCUS_BLOCK = 1 << 14  # 每次处理的位点数
+MISSING_CODE = ord('N')
+
+# (REF, ALT) -> 杂合子的IUPAC字符
+HET_CODE = np.full((256, 256), MISSING_CODE, dtype=np.uint8)
+for _pair, _code in (('AG', 'R'), ('CT', 'Y'), ('CG', 'S'), ('AT', 'W'), ('GT', 'K'), ('AC', 'M')):
+    HET_CODE[ord(_pair[0]), ord(_pair[1])] = HET_CODE[ord(_pair[1]), ord(_pair[0])] = ord(_code)
+
+
+def parse_genotypes(gts, n_samples):
+    # gts为每个样本GT字段前3个字节的拼接，返回 (位点数, 样本数) 的int8矩阵
+    # 只保留双等位的二倍体基因型；多于一个ALT的等位基因和无法解析的基因型记为缺失
+    codes = np.frombuffer(gts, dtype=np.uint8).reshape(-1, n_samples, 3).astype(np.int16) - ord('0')
+    a, b = codes[..., 0], codes[..., 2]
+    valid = (a >= 0) & (a <= 1) & (b >= 0) & (b <= 1)
+    return np.where(valid, a + b, -1).astype(np.int8)
+
+
+class GenotypeMatrix:
+    # prefix.i8（基因型）、prefix.alleles.u8（每个位点的REF/ALT字符）、
+    # prefix.loci.tsv（CHROM、POS、ID）和prefix.samples.tsv组成的基因型矩阵
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(f'{prefix}.samples.tsv') as f:
+            self.samples = [line.rstrip('\n') for line in f]
+        n_loci = os.path.getsize(f'{prefix}.alleles.u8') // 2
+        shape = (n_loci, len(self.samples))
+        if n_loci and self.samples:
+            self.alleles = np.memmap(f'{prefix}.alleles.u8', dtype=np.uint8, mode='r', shape=(n_loci, 2))
+            self.genotypes = np.memmap(f'{prefix}.i8', dtype=np.int8, mode='r', shape=shape)
+        else:
+            self.alleles = np.zeros((n_loci, 2), dtype=np.uint8)
+            self.genotypes = np.zeros(shape, dtype=np.int8)
+
+    @property
+    def n_loci(self):
+        return self.genotypes.shape[0]
+
+    def blocks(self, block=LOCUS_BLOCK):
+        # 逐块产生 (位点切片, 该块的基因型)
+        for start in range(0, self.n_loci, block):
+            loci = slice(start, min(start + block, self.n_loci))
+            yield loci, np.asarray(self.genotypes[loci])
+
+    def loci(self):
+        # 逐行产生 (CHROM, POS, ID)
+        with open(f'{self.prefix}.loci.tsv') as f:
+            for line in f:
+                yield line.rstrip('\n').split('\t')
+
+
+def vcf_to_genotypes(vcf, prefix, block=LOCUS_BLOCK):
+    # 流式读取VCF，写出GenotypeMatrix的各文件并返回它；每次只在内存中保留block个位点
+    samples = None
+    with open(vcf, 'rb') as f, open(f'{prefix}.i8', 'wb') as gt_out, \
+            open(f'{prefix}.alleles.u8', 'wb') as allele_out, open(f'{prefix}.loci.tsv', 'wb') as loci_out:
+
+        def flush(gts, alleles, loci):
+            if loci:
+                gt_out.write(parse_genotypes(b''.join(gts), len(samples)).tobytes())
+                allele_out.write(b''.join(alleles))
+                loci_out.write(b''.join(loci))
+
+        gts, alleles, loci = [], [], []
+        for line in f:
+            if line.startswith(b'##'):
+                continue
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            if line.startswith(b'#'):
+                samples = [name.decode() for name in fields[9:]]
+                continue
+            ref, alt = fields[3], fields[4].split(b',')[0]
+            if len(ref) != 1 or len(alt) != 1:
+                # 不是单碱基SNP：等位基因记为N，位点在比对中全部缺失
+                ref = alt = b'N'
+            alleles.append(ref.upper() + alt.upper())
+            gts.extend(field[:3].ljust(3, b'.') for field in fields[9:])
+            loci.append(b'\t'.join(fields[:3]) + b'\n')
+            if len(loci) >= block:
+                flush(gts, alleles, loci)
+                gts, alleles, loci = [], [], []
+        if samples is None:
+            raise ValueError(f"'{vcf}' 没有#CHROM标题行。")
+        flush(gts, alleles, loci)
+    with open(f'{prefix}.samples.tsv', 'w') as f:
+        f.writelines(f'{sample}\n' for sample in samples)
+    return GenotypeMatrix(prefix)
+
+
+def locus_stats(genotypes):
+    # 一块基因型（位点 x 样本）中每个位点的检出率、次要等位基因频率和观测杂合度
+    called = (genotypes >= 0).sum(axis=1)
+    n = max(genotypes.shape[1], 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alt = np.where(genotypes > 0, genotypes, 0).sum(axis=1) / (2 * called)
+        het = (genotypes == 1).sum(axis=1) / called
+    alt = np.nan_to_num(alt)
+    return {
+        'call_rate': called / n,
+        'maf': np.minimum(alt, 1 - alt),
+        'obs_het': np.nan_to_num(het),
+    }
+
+
+def sample_stats(matrix, block=LOCUS_BLOCK):
+    # 每个样本检出的位点数、缺失率和杂合率（杂合位点 / 检出位点）
+    called = np.zeros(len(matrix.samples), dtype=np.int64)
+    het = np.zeros(len(matrix.samples), dtype=np.int64)
+    for _, genotypes in matrix.blocks(block):
+        called += (genotypes >= 0).sum(axis=0)
+        het += (genotypes == 1).sum(axis=0)
+    n_loci = max(matrix.n_loci, 1)
+    return {
+        'called': called,
+        'missing_frac': 1 - called / n_loci,
+        'het_frac': het / np.maximum(called, 1),
+    }
+
+
+def filter_loci(matrix, locus_report, min_maf=0.0, min_call_rate=0.0, max_obs_het=1.0,
+                block=LOCUS_BLOCK):
+    # 按次要等位基因频率、检出率和观测杂合度过滤位点，逐块写出每个位点的统计（locus_report，TSV）
+    # 返回保留位点的布尔数组
+    keep = np.zeros(matrix.n_loci, dtype=bool)
+    loci = matrix.loci()
+    with open(locus_report, 'w') as f:
+        f.write('chrom\tpos\tid\tcall_rate\tmaf\tobs_het\tkept\n')
+        for sl, genotypes in matrix.blocks(block):
+            stats = locus_stats(genotypes)
+            ok = ((stats['maf'] >= min_maf) & (stats['call_rate'] >= min_call_rate)
+                  & (stats['obs_het'] <= max_obs_het))
+            keep[sl] = ok
+            for i in range(len(ok)):
+                chrom, pos, locus_id = next(loci)
+                f.write(f"{chrom}\t{pos}\t{locus_id}\t{stats['call_rate'][i]:.4f}\t"
+                        f"{stats['maf'][i]:.4f}\t{stats['obs_het'][i]:.4f}\t{int(ok[i])}\n")
+    return keep
+
+
+def write_sample_report(matrix, sample_report, block=LOCUS_BLOCK):
+    stats = sample_stats(matrix, block)
+    with open(sample_report, 'w') as f:
+        f.write('sample\tcalled_loci\tmissing_frac\thet_frac\n')
+        for i, sample in enumerate(matrix.samples):
+            f.write(f"{sample}\t{stats['called'][i]}\t{stats['missing_frac'][i]:.4f}\t"
+                    f"{stats['het_frac'][i]:.4f}\n")
+    return stats
+
+
+def genotypes_to_alignment(matrix, keep, workdir=None, mmap_bytes=MMAP_BYTES, block=LOCUS_BLOCK):
+    # 保留位点的基因型转换为比对矩阵（样本 x 位点，uint8）：纯合为REF/ALT，杂合为IUPAC字符，缺失为N
+    # 返回 (样本名列表, 矩阵)，与migseq2.align.load_phylip相同
+    n_sites = int(keep.sum())
+    shape = (len(matrix.samples), n_sites)
+    if shape[0] * shape[1] > mmap_bytes:
+        with tempfile.NamedTemporaryFile(dir=workdir, suffix='.phylip.u8') as tmp:
+            alignment = np.memmap(tmp.name, dtype=np.uint8, mode='w+', shape=shape)
+    else:
+        alignment = np.empty(shape, dtype=np.uint8)
+    col = 0
+    for sl, genotypes in matrix.blocks(block):
+        kept = keep[sl]
+        genotypes = genotypes[kept]
+        if not len(genotypes):
+            continue
+        alleles = np.asarray(matrix.alleles[sl])[kept]
+        ref, alt = alleles[:, :1], alleles[:, 1:]
+        het = HET_CODE[ref, alt]
+        chars = np.where(genotypes == 0, ref, np.where(genotypes == 2, alt, np.where(
+            genotypes == 1, het, MISSING_CODE)))
+        alignment[:, col:col + len(genotypes)] = chars.T
+        col += len(genotypes)
+    return list(matrix.samples), alignment
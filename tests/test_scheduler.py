@@ -0,0 +1,61 @@
+# CpuScheduler: backfilling small jobs must not starve a wide job waiting for the whole budget
+import threading
+import time
+
+from migseq2.core import CpuScheduler
+
+
+def test_small_job_backfills_while_wide_job_waits():
+    scheduler = CpuScheduler(4, backfill_wait=60)
+    release = threading.Event()
+    wide_started = threading.Event()
+
+    def hold(threads, started=None):
+        with scheduler.reserve(threads):
+            if started is not None:
+                started.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold, args=(2,))
+    holder.start()
+    time.sleep(0.05)
+    wide = threading.Thread(target=hold, args=(4, wide_started))
+    wide.start()
+    time.sleep(0.05)
+    # 2 of 4 threads are free: the 1-thread job starts ahead of the waiting wide job
+    with scheduler.reserve(1) as threads:
+        assert threads == 1
+        assert not wide_started.is_set()
+    release.set()
+    holder.join()
+    wide.join()
+    assert wide_started.is_set()
+
+
+def test_wide_job_waiting_behind_small_jobs_starts():
+    scheduler = CpuScheduler(4, backfill_wait=0.2)
+    stop = threading.Event()
+
+    def small_jobs():
+        while not stop.is_set():
+            with scheduler.reserve(1):
+                time.sleep(0.02)
+
+    workers = [threading.Thread(target=small_jobs) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    # the stream of small jobs is stopped after 5 s at the latest, so a starved job fails instead of hanging
+    timer = threading.Timer(5, stop.set)
+    timer.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    try:
+        with scheduler.reserve(4) as threads:
+            waited = time.monotonic() - start
+    finally:
+        stop.set()
+        timer.cancel()
+        for worker in workers:
+            worker.join()
+    assert threads == 4
+    assert waited < 2